@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark of the translation script.
+Command-line application that generates a synthetic Android resource tree and times the parsing, the file
+rewriting and the full translation path against the offline fake provider, as well as the startup of the
+script (import, --help and a run answered by the translation memory). The results are printed as JSON,
+so they can be saved and compared between versions.
+"""
+from __future__ import print_function
+
+from contextlib import redirect_stdout
+import argparse
+import configparser
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import translate
+
+# Folder qualifiers used for the synthetic languages. Each one resolves to a different target language, so no
+# folder is skipped or shares the translation of another one
+LANGUAGES = ['ar', 'de', 'es', 'fr', 'it', 'ja', 'ko', 'nl', 'pl', 'pt', 'ru', 'sv', 'tr', 'zh-rCN', 'zh-rTW', 'af',
+             'am', 'az', 'be', 'bg', 'bn', 'bs', 'ca', 'ceb', 'co', 'cs', 'cy', 'da', 'el', 'eo', 'et', 'eu', 'fa',
+             'fi', 'fy', 'ga', 'gd', 'gl', 'gu', 'ha', 'haw', 'he', 'hi', 'hmn', 'hr', 'ht', 'hu', 'hy', 'id', 'ig',
+             'is', 'jv', 'ka', 'kk', 'km', 'kn', 'ku', 'ky', 'la', 'lb', 'lo', 'lt', 'lv', 'mg', 'mi', 'mk', 'ml',
+             'mn', 'mr', 'ms', 'mt', 'my', 'ne', 'no', 'ny', 'or', 'pa', 'ps', 'ro', 'rw', 'sd', 'si', 'sk', 'sl',
+             'sm', 'sn', 'so', 'sq', 'sr', 'st', 'su', 'sw', 'ta', 'te', 'tg', 'th', 'tk', 'tl', 'tt', 'ug', 'uk',
+             'ur', 'uz', 'vi', 'xh', 'yi', 'yo', 'zu']
+WORDS = ['account', 'cancel', 'connection', 'download', 'error', 'file', 'loading', 'message', 'network', 'open',
+         'please', 'retry', 'save', 'settings', 'share', 'try', 'update', 'user', 'wait', 'welcome']
+
+
+def generate_tree(base_path, locales, keys, value_length, seed=0):
+    """
+    Generate a synthetic resource tree, with a base strings.xml and one strings.xml per language
+    containing about 80% of the keys.
+    :param base_path:
+    :param locales: number of language folders, at most the number of LANGUAGES
+    :param keys: number of strings of the base file
+    :param value_length: approximate number of characters of each value
+    :param seed: random seed, so the same parameters always generate the same tree
+    :return string_dict: the base strings
+    """
+    rand = random.Random(seed)
+    string_dict = {}
+    for index in range(keys):
+        words = []
+        while len(' '.join(words)) < value_length:
+            words.append(rand.choice(WORDS))
+        string_dict['key_%d' % index] = ' '.join(words).capitalize()
+
+    write_strings(os.path.join(base_path, 'values'), string_dict)
+    for language in LANGUAGES[:locales]:
+        locale_dict = dict((key, '[' + language + '] ' + value) for key, value in string_dict.items()
+                           if rand.random() < 0.8)
+        write_strings(os.path.join(base_path, 'values-' + language), locale_dict)
+    return string_dict
+
+
+def write_strings(path, string_dict):
+    if not os.path.exists(path):
+        os.makedirs(path)
+    with open(os.path.join(path, 'strings.xml'), 'w', encoding='utf-8') as strings_file:
+        strings_file.write('<?xml version="1.0" encoding="utf-8"?>\n<resources>\n')
+        for key, value in string_dict.items():
+            strings_file.write('    <string name="' + key + '">' + value + '</string>\n')
+        strings_file.write('</resources>\n')
+
+
+def measure(function, repeat, teardown=None):
+    """
+    Run the function repeat times with its output discarded.
+    :param function: function without parameters
+    :param repeat:
+    :param teardown: function without parameters called after each run, out of the timing
+    :return timing: dictionary with min, median and mean seconds
+    """
+    times = []
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+            if teardown is not None:
+                teardown()
+    times.sort()
+    return {
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'mean': sum(times) / len(times),
+    }
+
+
+def measure_command(command, repeat, cwd=None):
+    """
+    Run the command repeat times with its output discarded, so the time includes the interpreter startup.
+    :param command: list of arguments
+    :param repeat:
+    :param cwd: working folder of the command
+    :return timing: dictionary with min, median and mean seconds
+    """
+    return measure(lambda: subprocess.run(command, cwd=cwd, stdout=subprocess.DEVNULL, check=True), repeat)
+
+
+def fake_client(latency):
+    config = configparser.ConfigParser()
+    config.read_dict({'translate': {'fake_latency': str(latency)}})
+    return translate.TranslationClient(settings_path=os.devnull, use_cache=False,
+                                       provider=translate.FakeProvider(config['translate']))
+
+
+def run_benchmarks(args):
+    """
+    Generate the resource tree and time each path of the script.
+    :param args: parsed command line arguments
+    :return results: dictionary with the parameters and the timings of each benchmark
+    """
+    base_path = tempfile.mkdtemp(prefix='translate-benchmark-')
+    try:
+        string_dict = generate_tree(base_path, args.locales, args.keys, args.value_length)
+        string_list = list(string_dict.keys())
+        locale_path = sorted(path for path in os.listdir(base_path) if path.startswith('values-'))[0]
+        locale_file = os.path.join(base_path, locale_path, 'strings.xml')
+        translated_dict = dict((key, '[xx] ' + value) for key, value in string_dict.items())
+        script = os.path.abspath(translate.__file__)
+        # Every string is at the translation memory after the first run, so the next ones don't send anything
+        with open(os.path.join(base_path, translate.SETTINGS_FILE), 'w') as settings_file:
+            settings_file.write('[translate]\nprovider = fake\n')
+        cached_command = [sys.executable, script, '--incremental', '--dry-run', '.']
+        subprocess.run(cached_command, cwd=base_path, stdout=subprocess.DEVNULL, check=True)
+        # The rewritten files are staged and discarded after each run, so every run changes the same files
+        # instead of finding them already translated
+        stage = translate.FileStage()
+
+        benchmarks = {
+            'get_string_dict': measure(lambda: translate.get_string_dict(base_path, string_list), args.repeat),
+            'update_file': measure(lambda: translate.update_file(locale_file, translated_dict, False, stage=stage),
+                                   args.repeat, stage.discard),
+            'translate_files': measure(
+                lambda: translate.translate_files(fake_client(args.latency), base_path, string_dict, [], False,
+                                                  args.jobs, stage=stage),
+                args.repeat, stage.discard),
+            'import': measure_command([sys.executable, '-c', 'import translate'], args.repeat,
+                                      os.path.dirname(script)),
+            'help': measure_command([sys.executable, script, '--help'], args.repeat),
+            'cached_run': measure_command(cached_command, args.repeat, base_path),
+        }
+    finally:
+        shutil.rmtree(base_path)
+
+    return {
+        'python': platform.python_version(),
+        'parameters': {
+            'locales': args.locales,
+            'keys': args.keys,
+            'value_length': args.value_length,
+            'latency': args.latency,
+            'jobs': args.jobs,
+            'repeat': args.repeat,
+        },
+        'benchmarks': benchmarks,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare the median times with a previous result.
+    :param results:
+    :param baseline: results loaded from a previous run
+    :param threshold: maximum allowed slowdown ratio, eg. 0.2 for 20%
+    :return regression_list: names of the benchmarks slower than the threshold
+    """
+    regression_list = []
+    for name, timing in sorted(results['benchmarks'].items()):
+        if name not in baseline['benchmarks']:
+            continue
+        ratio = timing['median'] / baseline['benchmarks'][name]['median']
+        print("%-16s %.4fs -> %.4fs (%+.1f%%)" % (name, baseline['benchmarks'][name]['median'], timing['median'],
+                                                (ratio - 1) * 100), file=sys.stderr)
+        if ratio - 1 > threshold:
+            regression_list.append(name)
+    return regression_list
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the translation script with a synthetic android resource tree.")
+    parser.add_argument("-l", "--locales", type=int, default=20,
+                        help="Number of language folders, at most %d" % len(LANGUAGES))
+    parser.add_argument("-k", "--keys", type=int, default=500, help="Number of strings of the base file")
+    parser.add_argument("--value-length", type=int, default=40, help="Approximate characters of each string")
+    parser.add_argument("--latency", type=float, default=0, help="Seconds spent by the fake provider per request")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of languages translated at the same time")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Number of times each benchmark is run")
+    parser.add_argument("-o", "--output", type=str, help="File where the JSON results are saved")
+    parser.add_argument("--compare", type=str, help="JSON results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Slowdown ratio reported as a regression by --compare. eg. 0.2")
+    args = parser.parse_args()
+    if args.locales > len(LANGUAGES):
+        parser.error("at most %d locales are supported" % len(LANGUAGES))
+
+    results = run_benchmarks(args)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regression_list = compare(results, json.load(baseline_file), args.threshold)
+        if regression_list:
+            print("Regressions: " + ", ".join(regression_list), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the AsyncTranslateEngine against a local stub of the Translate REST API: connection pooling,
+retry of the rate limited requests and supported languages.
+"""
+import configparser
+import json
+import os
+import sys
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import translate
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Translate API v2 stub, translating each text to itself prefixed by the target language.
+    """
+
+    # Keep-alive connections, as the real API
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # Each handler serves a single connection
+        with self.server.lock:
+            self.server.connection_count += 1
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        with self.server.lock:
+            self.server.request_count += 1
+            rate_limited = self.server.rate_limited > 0
+            self.server.rate_limited -= 1
+        if form.get('key') != ['test-key']:
+            self.reply(400, {'error': {'message': 'API key not valid'}})
+        elif self.path.endswith('/languages'):
+            self.reply(200, {'data': {'languages': [{'language': 'de'}, {'language': 'es'}]}})
+        elif rate_limited:
+            self.reply(429, {'error': {'message': 'rateLimitExceeded'}}, {'Retry-After': '0.2'})
+        else:
+            translations = [{'translatedText': '[' + form['target'][0] + '] ' + text} for text in form['q']]
+            self.reply(200, {'data': {'translations': translations}})
+
+    def reply(self, status, data, headers=None):
+        content = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AsyncTranslateEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.lock = threading.Lock()
+        self.server.connection_count = 0
+        self.server.request_count = 0
+        self.server.rate_limited = 0
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.endpoint = 'http://127.0.0.1:%d/language/translate/v2' % self.server.server_address[1]
+        # The retries wait only what the server asks
+        self.base_backoff = translate.RETRY_BASE_BACKOFF
+        translate.RETRY_BASE_BACKOFF = 0
+
+    def tearDown(self):
+        translate.RETRY_BASE_BACKOFF = self.base_backoff
+        self.server.shutdown()
+        self.server.server_close()
+
+    def client(self, max_in_flight=2):
+        config = configparser.ConfigParser()
+        config.read_dict({'translate': {'api_key': 'test-key', 'endpoint': self.endpoint,
+                                        'max_in_flight': str(max_in_flight)}})
+        return translate.TranslationClient(settings_path=os.devnull, use_cache=False,
+                                           provider=translate.RestTranslateProvider(config['translate']))
+
+    def test_languages(self):
+        engine = translate.AsyncTranslateEngine('test-key', self.endpoint)
+        try:
+            self.assertEqual(engine.languages(), ['de', 'es'])
+        finally:
+            engine.close()
+
+    def test_connections_are_reused(self):
+        engine = translate.AsyncTranslateEngine('test-key', self.endpoint)
+        try:
+            for _ in range(3):
+                engine.languages()
+        finally:
+            engine.close()
+        self.assertEqual(engine.connection_count, 1)
+        self.assertEqual(self.server.connection_count, 1)
+        self.assertEqual(self.server.request_count, 3)
+
+    def test_batches_share_the_pool(self):
+        client = self.client(max_in_flight=2)
+        sources = ['Text %d' % index for index in range(translate.MAX_SEGMENTS_PER_REQUEST * 3)]
+        try:
+            translated_list = translate.translate_many(client, sources, 'de')
+        finally:
+            client.close()
+        self.assertEqual(translated_list, ['[de] ' + source for source in sources])
+        self.assertEqual(self.server.request_count, 3)
+        self.assertLessEqual(self.server.connection_count, 2)
+
+    def test_rate_limited_request_is_retried(self):
+        self.server.rate_limited = 1
+        client = self.client()
+        try:
+            self.assertEqual(translate.translate_many(client, ['Hello', 'Bye %s'], 'es'),
+                             ['[es] Hello', '[es] Bye %s'])
+        finally:
+            client.close()
+        self.assertEqual(self.server.request_count, 2)
+        self.assertEqual(client.retry_count, 1)
+        self.assertGreaterEqual(client.retry_time, 0.2)
+
+    def test_permanent_error_is_raised(self):
+        engine = translate.AsyncTranslateEngine('wrong-key', self.endpoint)
+        try:
+            with self.assertRaises(translate.RestApiError) as context:
+                engine.languages()
+        finally:
+            engine.close()
+        self.assertEqual(context.exception.status, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+"""Round trip tests of the resource model: parse a base file, translate it with the fake provider and
+rewrite a language file, which must stay valid XML with the same markup.
+"""
+import configparser
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+from xml.dom import minidom
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import translate
+
+BASE_STRINGS = '''<?xml version="1.0" encoding="utf-8"?>
+<resources>
+    <string name="link"><![CDATA[Click <a href="https://x.y">here</a>]]></string>
+    <string name="literal">Use &lt;name&gt; here</string>
+    <string name="styled">Welcome <b>%1$s</b>, you\\'ve got mail &amp; news</string>
+    <string name="handle">\\@team/android</string>
+    <string name="alias">@string/link</string>
+</resources>
+'''
+LANGUAGE_STRINGS = '''<?xml version="1.0" encoding="utf-8"?>
+<resources>
+</resources>
+'''
+
+
+def fake_client():
+    config = configparser.ConfigParser()
+    config.read_dict({'translate': {}})
+    return translate.TranslationClient(settings_path=os.devnull, use_cache=False,
+                                       provider=translate.FakeProvider(config['translate']))
+
+
+class RoundTripTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp()
+        for folder, content in (('values', BASE_STRINGS), ('values-de', LANGUAGE_STRINGS)):
+            os.makedirs(os.path.join(self.base_path, folder))
+            with open(os.path.join(self.base_path, folder, 'strings.xml'), 'w', encoding='utf-8') as strings_file:
+                strings_file.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path)
+
+    def test_decode_encode(self):
+        for raw_value in ['<![CDATA[Click <a href="https://x.y">here</a>]]>',
+                          'Use &lt;name&gt; here',
+                          "Welcome <b>%1$s</b>, you\\'ve got mail &amp; news",
+                          "<![CDATA[It\\'s <b>\"bold\"</b>]]>",
+                          '"  Keep   spaces "',
+                          '\\@team/android',
+                          '\\?attr/hint',
+                          '@string/link']:
+            self.assertEqual(translate.encode_android_value(translate.decode_android_value(raw_value)), raw_value)
+
+    def test_literal_tag_is_text(self):
+        value = translate.decode_android_value('Use &lt;name&gt; here')
+        self.assertEqual(translate.mask_placeholders(value), (value, []))
+
+    def test_translated_file_is_valid_xml(self):
+        string_dict = translate.get_string_dict(self.base_path)
+        failed_list = translate.translate_files(fake_client(), self.base_path, string_dict, [], False)
+        self.assertEqual(failed_list, [])
+
+        language_file = os.path.join(self.base_path, 'values-de', 'strings.xml')
+        document = minidom.parse(language_file)
+        strings = dict((node.getAttribute('name'), node) for node in document.getElementsByTagName('string'))
+        cdata_list = [node.data for node in strings['link'].childNodes if node.nodeType == node.CDATA_SECTION_NODE]
+        self.assertEqual(cdata_list, ['Click <a href="https://x.y">here</a>'])
+        self.assertEqual(strings['literal'].firstChild.data, '[de] Use <name> here')
+        self.assertEqual([node.tagName for node in strings['styled'].getElementsByTagName('*')], ['b'])
+        # The references are not written to the language files
+        self.assertEqual(strings['handle'].firstChild.data, '[de] @team/android')
+        self.assertNotIn('alias', strings)
+        self.assertEqual(translate.read_resources(language_file)['styled'],
+                         "[de] Welcome <b>%1$s</b>, you've got mail &amp; news")
+
+    def test_import_is_remembered(self):
+        string_dict = translate.get_string_dict(self.base_path)
+        translate.save_manifest(self.base_path, string_dict)
+        with open(os.path.join(self.base_path, 'values', 'strings.xml'), 'w', encoding='utf-8') as strings_file:
+            strings_file.write(BASE_STRINGS.replace('Use &lt;name&gt; here', 'Stop'))
+        base_dict = translate.get_string_dict(self.base_path)
+        changed_dict, removed_list = translate.diff_manifest(translate.load_manifest(self.base_path), base_dict)
+        self.assertEqual(changed_dict, {'literal': 'Stop'})
+
+        bundle_path = os.path.join(self.base_path, 'bundle.csv')
+        translate.export_bundle(bundle_path, [(self.base_path, changed_dict, [], base_dict)], [])
+        # Only the changed string is translated by the vendor, the missing ones are left without target
+        with open(bundle_path, encoding='utf-8') as bundle_file:
+            content = bundle_file.read()
+        with open(bundle_path, 'w', encoding='utf-8') as bundle_file:
+            bundle_file.write(content.replace(',literal,Stop,', ',literal,Stop,Anhalten'))
+
+        memory = translate.TranslationMemory(os.path.join(self.base_path, 'cache.db'))
+        try:
+            counts, done_dict = translate.import_bundle(bundle_path, False, memory=memory, provider_name='fake')
+            self.assertEqual(memory.get_many(['Stop'], 'de', 'fake'), {'Stop': 'Anhalten'})
+        finally:
+            memory.close()
+        self.assertEqual(counts['imported'], 1)
+        for base_path, base_done_dict in done_dict.items():
+            translate.update_manifest(base_path, base_done_dict)
+        # The next incremental run has nothing to translate
+        self.assertEqual(translate.diff_manifest(translate.load_manifest(self.base_path), base_dict), ({}, []))
+
+    def test_empty_array_items_keep_their_index(self):
+        with open(os.path.join(self.base_path, 'values', 'strings.xml'), 'w', encoding='utf-8') as strings_file:
+            strings_file.write('''<resources>
+    <string-array name="letters">
+        <item>Alpha</item>
+        <item></item>
+        <item>Gamma</item>
+    </string-array>
+</resources>
+''')
+        string_dict = translate.get_string_dict(self.base_path)
+        self.assertEqual(list(string_dict.values()), ['Alpha', '', 'Gamma'])
+        translate.translate_files(fake_client(), self.base_path, string_dict, [], False)
+        language_dict = translate.read_resources(os.path.join(self.base_path, 'values-de', 'strings.xml'))
+        self.assertEqual(list(language_dict.items()),
+                         [('letters[0]', '[de] Alpha'), ('letters[1]', ''), ('letters[2]', '[de] Gamma')])
+
+    def test_language_folder_without_file(self):
+        os.makedirs(os.path.join(self.base_path, 'values-fr'))
+        self.assertEqual(translate.build_report([self.base_path], [])['modules'][0]['folders']['fr']['missing'],
+                         ['link', 'literal', 'styled', 'handle'])
+        string_dict = translate.get_string_dict(self.base_path)
+        stage = translate.FileStage()
+        try:
+            self.assertEqual(translate.translate_files(fake_client(), self.base_path, string_dict, [], False,
+                                                       stage=stage), [])
+            stage.commit()
+        finally:
+            stage.discard()
+        language_dict = translate.read_resources(os.path.join(self.base_path, 'values-fr', 'strings.xml'))
+        self.assertEqual(language_dict['handle'], '[fr] @team/android')
+
+    def test_escaped_reference_is_text(self):
+        client = fake_client()
+        value = translate.decode_android_value('\\@team/android')
+        self.assertFalse(translate.is_reference(value))
+        self.assertEqual(translate.translate_many(client, [value], 'de'), ['[de] @team/android'])
+        self.assertEqual(client.request_count, 1)
+        # Even if the translator leaves it as it is, it is still written escaped
+        self.assertEqual(translate.encode_android_value(value), '\\@team/android')
+
+    def test_report_keeps_folders_of_same_language(self):
+        for folder in ('values-es', 'values-es-rMX'):
+            os.makedirs(os.path.join(self.base_path, folder))
+            with open(os.path.join(self.base_path, folder, 'strings.xml'), 'w', encoding='utf-8') as strings_file:
+                strings_file.write(LANGUAGE_STRINGS)
+        report = translate.build_report([self.base_path], [])
+        folder_dict = report['modules'][0]['folders']
+        self.assertEqual(dict((qualifiers, result['language']) for qualifiers, result in folder_dict.items()),
+                         {'de': 'de', 'es': 'es', 'es-rMX': 'es'})
+        self.assertEqual(report['totals']['missing'], 12)
+
+    def test_report_extra_keys(self):
+        with open(os.path.join(self.base_path, 'values', 'strings.xml'), 'w', encoding='utf-8') as strings_file:
+            strings_file.write(BASE_STRINGS.replace('</resources>',
+                                                    '<string name="app" translatable="false">App</string></resources>'))
+        with open(os.path.join(self.base_path, 'values-de', 'strings.xml'), 'w', encoding='utf-8') as strings_file:
+            strings_file.write('<resources><string name="app">App</string><string name="old">Alt</string>'
+                               '<string name="alias">@string/link</string></resources>')
+        self.assertEqual(translate.build_report([self.base_path], [])['modules'][0]['folders']['de']['extra'],
+                         ['old'])
+
+    def test_import_keeps_array_references(self):
+        base_file = os.path.join(self.base_path, 'values', 'strings.xml')
+        with open(base_file, 'w', encoding='utf-8') as strings_file:
+            strings_file.write(BASE_STRINGS.replace('</resources>', '''    <string-array name="menu">
+        <item>Open</item>
+        <item>@string/link</item>
+        <item></item>
+        <item>Close</item>
+    </string-array>
+</resources>'''))
+        string_dict = translate.get_string_dict(self.base_path)
+        bundle_path = os.path.join(self.base_path, 'bundle.xlf')
+        count = translate.export_bundle(bundle_path, [(self.base_path, string_dict, [], None)], [])
+        self.assertEqual(count, 6)
+
+        # Translate the bundle as a translation tool would, filling the targets
+        with open(bundle_path, encoding='utf-8') as bundle_file:
+            content = bundle_file.read()
+        content = re.sub(r'<source>(.*?)</source>', r'<source>\1</source><target>\1!</target>', content, flags=re.S)
+        with open(bundle_path, 'w', encoding='utf-8') as bundle_file:
+            bundle_file.write(content)
+
+        counts, done_dict = translate.import_bundle(bundle_path, False)
+        self.assertEqual(counts, {'imported': 6, 'stale': 0, 'invalid': 0})
+        language_dict = translate.read_resources(os.path.join(self.base_path, 'values-de', 'strings.xml'))
+        self.assertEqual([language_dict['menu[%d]' % index] for index in range(4)],
+                         ['Open!', translate.REFERENCE_MARK + '@string/link', '', 'Close!'])
+
+
+class PlaceholderTest(unittest.TestCase):
+
+    def test_format_placeholders(self):
+        self.assertEqual(translate.FORMAT_PATTERN.findall('%1$s has %2$d, %.2f%% or %-10s|%tY%n'),
+                         ['%1$s', '%2$d', '%.2f', '%%', '%-10s', '%tY', '%n'])
+
+    def test_prose_is_not_a_placeholder(self):
+        for text in ['Save 50% on', '100% sure', '80%, please', '50%off']:
+            self.assertEqual(translate.mask_placeholders(text), (text, []))
+
+    def test_shared_mask(self):
+        # Both sources mask to the same sentence, which is sent once and unmasked for each of them
+        client = fake_client()
+        self.assertEqual(translate.translate_many(client, ['%s items', '%d items', '%s items'], 'de'),
+                         ['[de] %s items', '[de] %d items', '[de] %s items'])
+        self.assertEqual(client.request_count, 1)
+
+    def test_cdata_text_is_escaped_for_the_translator(self):
+        value = translate.decode_android_value('<![CDATA[a < b & <b>c</b>]]>')
+        masked, placeholder_list = translate.mask_placeholders(value)
+        self.assertEqual(masked, '<x id="0"/>a &lt; b &amp; <x id="1"/>c<x id="2"/><x id="3"/>')
+        self.assertIsNone(translate.check_placeholders(masked, placeholder_list))
+        self.assertEqual(translate.unmask_placeholders(masked, placeholder_list), value)
+        client = fake_client()
+        self.assertEqual(translate.translate_many(client, [value], 'de'), ['[de] ' + value])
+        self.assertEqual(client.invalid_count, 0)
+
+    def test_added_markup_is_flagged(self):
+        masked, placeholder_list = translate.mask_placeholders('Hi <b>%s</b>')
+        self.assertIsNone(translate.check_placeholders(masked, placeholder_list))
+        for translation in ['<es> hola', 'hola %d', 'hola {name}', 'hola <i>']:
+            self.assertEqual(translate.check_placeholders(masked.replace('Hi', translation), placeholder_list),
+                             "placeholders or markup added")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,175 +7,2593 @@ from __future__ import print_function
 
 __author__ = 'computationalcore@gmail.com (Vin)'
 
-from xml.dom import minidom
+# Only the modules needed by every run are imported here. The network clients (googleapiclient, httplib2,
+# asyncio, http.client), the translation memory (sqlite3) and the modules of the other modes are imported
+# when they are first used, so --help, --report and the runs answered by the translation memory start fast
 from glob import glob
 import argparse
-import configparser
 import html
-from googleapiclient.discovery import build
+from contextlib import contextmanager
+from io import StringIO
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import random
+import re
+import threading
 from tempfile import mkstemp
-from shutil import move
+from shutil import move, copymode
 from os import remove, close
 import time
-import fileinput
 start_time = time.time()
 
-
-def translate(node):
-    if len(node.childNodes) == 0:
-        result = None
-    else:
-        result = node.firstChild.data
-    return result
+SETTINGS_FILE = 'project.settings'
+# Translate API v2 limits for a single translations.list request
+# https://cloud.google.com/translate/quotas
+MAX_SEGMENTS_PER_REQUEST = 128
+MAX_CHARS_PER_REQUEST = 5000
+# Fingerprints of the base strings saved by the incremental mode, relative to the base path
+MANIFEST_FILE = '.strings_manifest.json'
+# Scanner of the resource files, matches the comments (copied as is) and each string, plurals and string-array
+# element with its indentation and line break, so an element can be replaced or removed without touching the
+# rest of the file
+RESOURCE_PATTERN = re.compile(
+    r'<!--.*?-->'
+    r'|(?P<indent>^[ \t]*)?(?P<open><(?P<tag>string|plurals|string-array)\s[^>]*?name="(?P<name>[^"]*)"[^>]*?)'
+    r'(?:/>|>(?P<content>.*?)</(?P=tag)>)(?P<newline>[ \t]*\r?\n)?',
+    re.DOTALL | re.MULTILINE)
+ITEM_PATTERN = re.compile(r'<item\b(?P<attributes>[^>]*?)(?:/>|>(?P<content>.*?)</item>)', re.DOTALL)
+QUANTITY_PATTERN = re.compile(r'quantity="([^"]*)"')
+# Inline markup of the values (kept as is) and CDATA sections
+MARKUP_PATTERN = re.compile(r'<!\[CDATA\[(?P<cdata>.*?)\]\]>|</?[A-Za-z][\w:.-]*(?:\s[^<>]*)?/?>', re.DOTALL)
+# Markup of the decoded values: the inline tags and the limits of the CDATA sections. Everything else is text,
+# with the XML special characters escaped, so a text like &lt;name&gt; is never taken as a tag
+FRAGMENT_PATTERN = re.compile(r'<!\[CDATA\[|\]\]>|</?[A-Za-z][\w:.-]*(?:\s[^<>]*)?/?>')
+# Java format placeholders (%s, %1$d, %.2f, %tY, %%...), protected from the translator. Only the real conversions
+# match, the space and ',' flags need a width or a precision and no letter may follow, so prose like
+# '100% sure' or '50% off' is left alone
+FORMAT_PATTERN = re.compile(r'%(?:\d+\$)?(?:[-#+ 0,(]*(?:\d+(?:\.\d+)?|\.\d+)|[-#+0(]*)'
+                            r'(?:[tT][HIklMSLNpzZsQBbhAaCYyjmdeRTrDFc]|[bBhHsScCdoxXeEfgGaA%n])(?![a-zA-Z])')
+# Named and numbered placeholders of other formats, like {name} or {0}
+BRACE_PATTERN = re.compile(r'\{\w+\}')
+# Tokens masked before the translation: format placeholders, brace placeholders and inline markup tags
+TOKEN_PATTERN = re.compile('|'.join([FORMAT_PATTERN.pattern, BRACE_PATTERN.pattern, FRAGMENT_PATTERN.pattern]))
+TAG_PATTERN = re.compile(r'<(?P<close>/?)(?P<name>[A-Za-z][\w:.-]*)(?:\s[^<>]*)?(?P<empty>/?)>$')
+# References to other resources, like @string/app_name or ?attr/title
+REFERENCE_PATTERN = re.compile(r'[@?](?:[\w.]+:)?[\w-]+/[\w.]+$')
+# Mark of the references at the decoded values, since an escaped text like \@team/android decodes to the same
+# characters of a reference
+REFERENCE_MARK = '\0'
+# Same scanners over bytes, used to index the files without decoding them
+RESOURCE_BYTES_PATTERN = re.compile(RESOURCE_PATTERN.pattern.encode('ascii'), re.DOTALL | re.MULTILINE)
+ITEM_BYTES_PATTERN = re.compile(ITEM_PATTERN.pattern.encode('ascii'), re.DOTALL)
+QUANTITY_BYTES_PATTERN = re.compile(QUANTITY_PATTERN.pattern.encode('ascii'))
+PLACEHOLDER_PATTERN = re.compile(r'<x\s+id="(\d+)"\s*/?>(?:</x>)?')
+DEFAULT_INDENT = '    '
+# Android escape sequences, any other escaped character is taken as is
+ANDROID_ESCAPES = {'n': '\n', 't': '\t'}
+# Folders not walked when scanning a project for resource folders
+SCAN_IGNORED_DIRS = ('build', 'node_modules')
+# Translate API v2 price in dollars, used to estimate the cost of a run
+COST_PER_MILLION_CHARS = 20.0
+# Translate API v2 REST endpoint and requests at the same time, used by the google-rest provider
+TRANSLATE_ENDPOINT = 'https://translation.googleapis.com/language/translate/v2'
+MAX_IN_FLIGHT = 8
+# Retries of the temporary API failures, the backoff doubles at each attempt up to the maximum
+MAX_RETRIES = 5
+RETRY_BASE_BACKOFF = 1.0
+RETRY_MAX_BACKOFF = 60.0
+RETRY_STATUS = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+# Index of the keys of the language files, relative to the base path
+INDEX_FILE = '.strings_index.json'
+# Journal of the translations of the current run, used to resume it if it is interrupted
+JOURNAL_FILE = '.translate_journal.jsonl'
+# Translation memory defaults, both can be changed at the cache section of the settings file
+CACHE_FILE = '.translation_memory.sqlite'
+CACHE_MAX_ENTRIES = 100000
+# Target languages supported by each provider, fetched once and kept for a week
+LANGUAGES_FILE = '.supported_languages.json'
+LANGUAGES_MAX_AGE = 7 * 24 * 3600
+# Qualifiers of a language folder: optional mcc and mnc, then the language with an optional region (xx-rCC) or a
+# BCP-47 tag (b+sr+Latn). Folders with any other qualifier (night, sw600dp, v21, land...) are not languages
+LANGUAGE_QUALIFIER_PATTERN = re.compile(
+    r'(?:mcc\d+-)?(?:mnc\d+-)?(?:(?P<language>[a-z]{2,3})(?:-r(?P<region>[a-z]{2}|\d{3}))?|b\+(?P<tag>[a-z0-9+]+))$',
+    re.IGNORECASE)
+# Qualifiers of three letters that are not languages
+NON_LANGUAGE_QUALIFIERS = ('car', 'hdr')
+# Android and BCP-47 codes that the Translate API knows by another code, by language, language-script or
+# language-region
+LANGUAGE_CODES = {
+    'in': 'id',
+    'iw': 'he',
+    'ji': 'yi',
+    'jv': 'jw',
+    'nb': 'no',
+    'fil': 'tl',
+    'zh': 'zh-CN',
+    'zh-hans': 'zh-CN',
+    'zh-hant': 'zh-TW',
+    'zh-cn': 'zh-CN',
+    'zh-sg': 'zh-CN',
+    'zh-tw': 'zh-TW',
+    'zh-hk': 'zh-TW',
+    'zh-mo': 'zh-TW',
+}
+# Bundles of strings exported to be translated out of the API, XLIFF 1.2 by these extensions and CSV otherwise
+XLIFF_EXTENSIONS = ('.xlf', '.xliff')
+XLIFF_NAMESPACE = 'urn:oasis:names:tc:xliff:document:1.2'
+CSV_COLUMNS = ['file', 'language', 'key', 'source', 'target']
+# Language of the base strings.xml, it can be changed at the translate section of the settings file
+SOURCE_LANGUAGE = 'en'
+# Content of a new language file
+RESOURCES_SKELETON = '<?xml version="1.0" encoding="utf-8"?>\n<resources>\n</resources>\n'
+# Seconds between two checks of the base files at the watch mode
+WATCH_INTERVAL = 1.0
+# Percentiles of the API latency saved at the metrics
+LATENCY_PERCENTILES = (50, 90, 99)
 
 
-def get_string_dict(base_path, string_list):
+def get_string_dict(base_path, string_list=None):
     """
     Get the dictionary with the default key:value for each element of
     the string keys list passed.
+    The items of plurals and string-array resources have their own keys, name#quantity and name[index].
     :param base_path:
-    :param string_list:
+    :param string_list: list of resource names, None to get all the resources
     :return string_dict:
     """
-    string_dict = {}
-    baseDoc = minidom.parse(base_path + '/values/strings.xml')
-    strings = baseDoc.getElementsByTagName("string")
-    for string in strings:
-        # Push into the dictionary the pair of key value for string key and key value
-        if string.getAttribute("name") in string_list:
-            string_dict[string.getAttribute("name")] = string.firstChild.nodeValue
+    string_dict = read_resources(base_path + '/values/strings.xml')
+    if string_list is None:
+        return string_dict
+    return OrderedDict((key, value) for key, value in string_dict.items() if split_key(key)[0] in string_list)
+
+
+def read_resources(file_path, skipped_list=None):
+    """
+    Read the translatable text of the string, plurals and string-array resources of a file.
+    The resources marked as not translatable, the empty values and the references to other resources are left
+    out, except the empty and reference items of string-array, which are needed to keep the indices of the
+    array.
+    :param file_path:
+    :param skipped_list: list where the keys left out are added, None to not collect them
+    :return string_dict: ordered dictionary key:text, with the Android escaping removed
+    """
+    with open(file_path, encoding='utf-8') as resource_file:
+        content = resource_file.read()
+    string_dict = OrderedDict()
+    for match in RESOURCE_PATTERN.finditer(content):
+        if match.group('name') is None:
+            continue
+        for item, raw_value in get_resource_items(match).items():
+            key = make_key(match.group('name'), match.group('tag'), item)
+            raw_value = raw_value.strip()
+            if 'translatable="false"' in match.group('open') or (
+                    (not raw_value or REFERENCE_PATTERN.match(raw_value)) and match.group('tag') != 'string-array'):
+                if skipped_list is not None:
+                    skipped_list.append(key)
+                continue
+            string_dict[key] = decode_android_value(raw_value)
     return string_dict
 
 
-def translate_files(base_path, string_dict, ignored_language_list, verbose):
+def get_resource_items(match):
+    """
+    Get the raw values of a resource element.
+    :param match: RESOURCE_PATTERN match of the element
+    :return item_dict: ordered dictionary with the values by quantity for plurals, by index for string-array,
+    and a single None item for string
+    """
+    content = match.group('content') or ''
+    if match.group('tag') == 'string':
+        return OrderedDict([(None, content)])
+    item_dict = OrderedDict()
+    for index, item_match in enumerate(ITEM_PATTERN.finditer(content)):
+        if match.group('tag') == 'plurals':
+            quantity = QUANTITY_PATTERN.search(item_match.group('attributes'))
+            index = quantity.group(1) if quantity else str(index)
+        item_dict[index] = item_match.group('content') or ''
+    return item_dict
+
+
+def make_key(name, tag, item):
+    if tag == 'plurals':
+        return name + '#' + item
+    if tag == 'string-array':
+        return '%s[%d]' % (name, item)
+    return name
+
+
+def split_key(key):
+    """
+    Split a key of the strings dictionary.
+    :param key:
+    :return name, tag, item: resource name, tag and quantity or index of the item (None for string)
+    """
+    if '#' in key:
+        name, quantity = key.split('#', 1)
+        return name, 'plurals', quantity
+    if key.endswith(']') and '[' in key:
+        name, index = key[:-1].split('[', 1)
+        return name, 'string-array', int(index)
+    return key, 'string', None
+
+
+def decode_android_value(raw_value):
+    """
+    Convert the raw content of a resource element to the value to be translated, an XML fragment where the
+    text and the markup are kept apart. Out of the CDATA sections, the XML entities and the Android escaping
+    (quotes, backslashes, \\n, \\uXXXX, whitespace collapse) are removed from the text, which is then XML escaped
+    again, and the inline markup tags are kept as they are. The CDATA sections are kept with their tags as they
+    are, and only the backslash escaping is removed from their text.
+    A reference to another resource is kept as it is, after the REFERENCE_MARK.
+    :param raw_value:
+    :return value:
+    """
+    if REFERENCE_PATTERN.match(raw_value):
+        return REFERENCE_MARK + raw_value
+    parts = []
+    position = 0
+    for match in MARKUP_PATTERN.finditer(raw_value):
+        parts.append(html.escape(unescape_android(html.unescape(raw_value[position:match.start()])), quote=False))
+        if match.group('cdata') is not None:
+            parts.append('<![CDATA[' + decode_cdata(match.group('cdata')) + ']]>')
+        else:
+            parts.append(match.group(0))
+        position = match.end()
+    parts.append(html.escape(unescape_android(html.unescape(raw_value[position:])), quote=False))
+    return ''.join(parts)
+
+
+def decode_cdata(content):
+    """
+    Remove the Android escaping of the text of a CDATA section, leaving its tags and double quotes as they are.
+    :param content:
+    :return content:
+    """
+    parts = []
+    position = 0
+    for match in FRAGMENT_PATTERN.finditer(content):
+        parts.append(unescape_android(content[position:match.start()], quotes=False))
+        parts.append(match.group(0))
+        position = match.end()
+    parts.append(unescape_android(content[position:], quotes=False))
+    return ''.join(parts)
+
+
+def unescape_android(text, quotes=True):
+    """
+    Remove the Android string escaping. Out of double quotes the whitespace runs are collapsed to a single space.
+    :param text:
+    :param quotes: take the double quotes as quoting, otherwise they are kept as text
+    :return unescaped:
+    """
+    result = []
+    quoted = False
+    index = 0
+    while index < len(text):
+        char = text[index]
+        if char == '\\' and index + 1 < len(text):
+            escaped = text[index + 1]
+            if escaped == 'u' and re.match(r'[0-9a-fA-F]{4}', text[index + 2:index + 6]):
+                result.append(chr(int(text[index + 2:index + 6], 16)))
+                index += 6
+                continue
+            result.append(ANDROID_ESCAPES.get(escaped, escaped))
+            index += 2
+            continue
+        if char == '"' and quotes:
+            quoted = not quoted
+        elif not quoted and char.isspace():
+            if not result or result[-1] != ' ':
+                result.append(' ')
+        else:
+            result.append(char)
+        index += 1
+    return ''.join(result)
+
+
+def is_reference(value):
+    """
+    :param value: decoded value
+    :return reference: the value is a reference to another resource, not a text
+    """
+    return value.startswith(REFERENCE_MARK)
+
+
+def encode_android_value(value):
+    """
+    Convert a translated value, an XML fragment as given by decode_android_value, to the raw content of a
+    resource element. The text is escaped for Android (quotes, backslashes, new lines, leading @ and ?) and for
+    XML, the inline markup tags are kept as they are, and the text of the CDATA sections is only escaped for
+    Android.
+    :param value:
+    :return raw_value:
+    """
+    if is_reference(value):
+        return value[len(REFERENCE_MARK):]
+    parts = []
+    position = 0
+    in_cdata = False
+    for match in FRAGMENT_PATTERN.finditer(value):
+        parts.append(escape_android(value[position:match.start()], position == 0, in_cdata))
+        parts.append(match.group(0))
+        if match.group(0) == '<![CDATA[':
+            in_cdata = True
+        elif match.group(0) == ']]>':
+            in_cdata = False
+        position = match.end()
+    parts.append(escape_android(value[position:], position == 0, in_cdata))
+    raw_value = ''.join(parts)
+    # Leading, trailing or repeated whitespace is only kept inside double quotes
+    if re.search(r'^\s|\s$|\s\s', value):
+        raw_value = '"' + raw_value + '"'
+    return raw_value
+
+
+def escape_android(text, at_start, in_cdata=False):
+    """
+    :param text: text of a value, with the XML special characters escaped out of the CDATA sections
+    :param at_start: the text is at the start of the value
+    :param in_cdata: the text is inside a CDATA section, where it is not XML and the double quotes are text
+    :return raw_text:
+    """
+    if in_cdata:
+        text = text.replace('\\', '\\\\').replace("'", "\\'")
+        return text.replace('\n', '\\n').replace('\t', '\\t')
+    text = html.unescape(text)
+    text = text.replace('\\', '\\\\').replace("'", "\\'").replace('"', '\\"')
+    text = text.replace('\n', '\\n').replace('\t', '\\t')
+    # A leading @ or ? would make the value a reference to another resource
+    if at_start and text[:1] in ('@', '?'):
+        text = '\\' + text
+    return html.escape(text, quote=False)
+
+
+def mask_placeholders(text):
+    """
+    Replace the format placeholders (%1$s, {name}) and the inline markup tags with numbered tags the
+    translator leaves untouched.
+    :param text:
+    :return masked, placeholder_list:
+    """
+    placeholder_list = []
+
+    def mask(match):
+        placeholder_list.append(match.group(0))
+        return '<x id="%d"/>' % (len(placeholder_list) - 1)
+
+    # The translator works with HTML, so the text of the CDATA sections is XML escaped as the rest of the text
+    text = map_cdata_text(text, lambda part: html.escape(part, quote=False))
+    return TOKEN_PATTERN.sub(mask, text), placeholder_list
+
+
+def unmask_placeholders(text, placeholder_list):
+    def unmask(match):
+        index = int(match.group(1))
+        return placeholder_list[index] if index < len(placeholder_list) else match.group(0)
+
+    return map_cdata_text(PLACEHOLDER_PATTERN.sub(unmask, text), html.unescape)
+
+
+def map_cdata_text(value, function):
+    """
+    Apply a function to the text of the CDATA sections of a value, leaving the tags inside them as they are.
+    :param value: value as given by decode_android_value
+    :param function: function of a text part
+    :return value:
+    """
+    if '<![CDATA[' not in value:
+        return value
+    parts = []
+    position = 0
+    in_cdata = False
+    for match in FRAGMENT_PATTERN.finditer(value):
+        text = value[position:match.start()]
+        parts.append(function(text) if in_cdata else text)
+        parts.append(match.group(0))
+        if match.group(0) == '<![CDATA[':
+            in_cdata = True
+        elif match.group(0) == ']]>':
+            in_cdata = False
+        position = match.end()
+    parts.append(value[position:])
+    return ''.join(parts)
+
+
+def check_placeholders(translation, placeholder_list):
+    """
+    Check the masked translation before restoring its tokens. Each token must be found exactly once, the
+    markup tags must be nested as in the source, and the translator must not add placeholders or markup of
+    its own.
+    :param translation: masked translation
+    :param placeholder_list: tokens of the source
+    :return error: the problem found, None if the translation is valid
+    """
+    index_list = [int(match.group(1)) for match in PLACEHOLDER_PATTERN.finditer(translation)]
+    if sorted(index_list) != list(range(len(placeholder_list))):
+        return "placeholders changed"
+    # The text is XML escaped, so any tag or < left out of the masked tokens was added by the translator
+    text = PLACEHOLDER_PATTERN.sub('', translation)
+    if TOKEN_PATTERN.search(text) or '<' in text:
+        return "placeholders or markup added"
+    if is_nested(placeholder_list) and not is_nested([placeholder_list[index] for index in index_list]):
+        return "markup changed"
+    return None
+
+
+def check_translation(source, translation):
+    """
+    Check a translation done out of the API. It must have the same placeholders and markup tags of the source,
+    and the tags must be nested as in the source.
+    :param source:
+    :param translation:
+    :return error: the problem found, None if the translation is valid
+    """
+    source_list = TOKEN_PATTERN.findall(source)
+    translation_list = TOKEN_PATTERN.findall(translation)
+    if sorted(source_list) != sorted(translation_list):
+        return "placeholders changed"
+    if is_nested(source_list) and not is_nested(translation_list):
+        return "markup changed"
+    return None
+
+
+def is_nested(token_list):
+    """
+    Check that every markup tag of the tokens is closed in order.
+    :param token_list:
+    :return nested:
+    """
+    open_list = []
+    for token in token_list:
+        match = TAG_PATTERN.match(token)
+        if match is None or match.group('empty'):
+            continue
+        if not match.group('close'):
+            open_list.append(match.group('name'))
+        elif not open_list or open_list.pop() != match.group('name'):
+            return False
+    return not open_list
+
+
+def fingerprint(value):
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+def load_manifest(base_path):
+    """
+    Load the fingerprints of the base strings saved by the last incremental run.
+    :param base_path:
+    :return manifest: dictionary key:fingerprint, None if there is no manifest yet
+    """
+    manifest_path = os.path.join(base_path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_manifest(base_path, string_dict):
+    """
+    Save the fingerprints of the base strings, to be compared at the next incremental run.
+    :param base_path:
+    :param string_dict: all the base strings
+    :return:
+    """
+    manifest = dict((key, fingerprint(value)) for key, value in string_dict.items())
+    with open(os.path.join(base_path, MANIFEST_FILE), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+
+
+def update_manifest(base_path, done_dict):
+    """
+    Save at the manifest the fingerprints of the strings translated out of a translation run, so the next
+    incremental run doesn't translate them again. Without a manifest yet, every base string is saved, as the
+    first incremental run would do.
+    :param base_path:
+    :param done_dict: dictionary key:value of the base strings translated
+    :return:
+    """
+    manifest = load_manifest(base_path)
+    if manifest is None:
+        save_manifest(base_path, get_string_dict(base_path))
+        return
+    manifest.update((key, fingerprint(value)) for key, value in done_dict.items())
+    with open(os.path.join(base_path, MANIFEST_FILE), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+
+
+def diff_manifest(manifest, string_dict):
+    """
+    Compare the current base strings with the manifest of the last run.
+    :param manifest: dictionary key:fingerprint
+    :param string_dict: all the base strings
+    :return changed_dict, removed_list: added or modified strings and the keys deleted from the base file
+    """
+    changed_dict = {}
+    for key, value in string_dict.items():
+        if manifest.get(key) != fingerprint(value):
+            changed_dict[key] = value
+    removed_list = [key for key in manifest if key not in string_dict]
+    return changed_dict, removed_list
+
+
+class TranslationProvider(object):
+    """
+    Base class of the translation backends. A provider only knows how to translate a batch of texts,
+    the batching, caching and rate limiting are done by the TranslationClient.
+    """
+
+    # Name of the provider translations, part of the translation memory key
+    name = None
+    # The providers with translate_many_async can translate several batches at the same time
+    asynchronous = False
+    # Seconds spent building the backend on the first request, for the providers built lazily
+    setup_time = 0
+
+    def translate_many(self, texts, target):
+        """
+        Translate a batch of texts.
+        :param texts: list of sentences
+        :param target: target language
+        :return translated_list: the translations in the same order of the texts
+        """
+        raise NotImplementedError
+
+    def supported_languages(self):
+        """
+        Get the target languages supported by the backend.
+        :return language_list: list of language codes, None if any language is accepted
+        """
+        return None
+
+    def retry_after(self, error):
+        """
+        Check if a failed request can be retried.
+        :param error: exception raised by translate_many
+        :return seconds: minimum seconds to wait before retrying (0 if the server didn't say), None if the
+        error is not temporary
+        """
+        import socket
+        if isinstance(error, (ConnectionError, socket.timeout)):
+            return 0
+        return None
+
+    def close(self):
+        pass
+
+
+class GoogleTranslateProvider(TranslationProvider):
+    """
+    Google Translate API v2 backend.
+    """
+
+    name = 'google-v2'
+
+    def __init__(self, settings):
+        """
+        :param settings: translate section of the settings file
+        """
+        self.api_key = settings['api_key']
+        self._service = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def service(self):
+        """
+        Build the service on the first request, so the runs answered by the translation memory don't import
+        googleapiclient.
+        :return service:
+        """
+        with self._lock:
+            if self._service is None:
+                setup_start = time.time()
+                from googleapiclient.discovery import build
+                # The discovery document is cached, so building the service does not always hit the network
+                self._service = build('translate', 'v2', developerKey=self.api_key, cache_discovery=True)
+                self.setup_time = time.time() - setup_start
+        return self._service
+
+    def http(self):
+        """
+        Get the http connection of the current thread, since httplib2 connections are not thread safe.
+        :return http:
+        """
+        if not hasattr(self._local, 'http'):
+            import httplib2
+            self._local.http = httplib2.Http()
+        return self._local.http
+
+    def translate_many(self, texts, target):
+        # Use Google Translator API to translate the sentences <http://code.google.com/apis/console>
+        request = self.service.translations().list(q=texts, target=target)
+        # The service is shared, but each thread needs its own http connection
+        response = request.execute(http=self.http())
+        # The API answers the translations in the same order of the q values.
+        # The translations are HTML, like the values, with the text escaped
+        return [translation['translatedText'] for translation in response['translations']]
+
+    def supported_languages(self):
+        response = self.service.languages().list().execute(http=self.http())
+        return [language['language'] for language in response['languages']]
+
+    def retry_after(self, error):
+        from googleapiclient.errors import HttpError
+        if isinstance(error, HttpError):
+            if is_temporary_error(int(error.resp.status), error.content):
+                return parse_retry_after(error.resp.get('retry-after'))
+            return None
+        return TranslationProvider.retry_after(self, error)
+
+
+class RestTranslateProvider(TranslationProvider):
+    """
+    Google Translate API v2 backend calling the REST endpoint directly through an AsyncTranslateEngine,
+    so the batches of a language are sent at the same time over pooled keep-alive connections.
+    """
+
+    # Same translations of the GoogleTranslateProvider, so they share the translation memory
+    name = 'google-v2'
+    asynchronous = True
+
+    def __init__(self, settings):
+        """
+        :param settings: translate section of the settings file
+        """
+        self.engine = AsyncTranslateEngine(settings['api_key'],
+                                           settings.get('endpoint', TRANSLATE_ENDPOINT),
+                                           settings.getint('max_in_flight', MAX_IN_FLIGHT))
+
+    def translate_many(self, texts, target):
+        import asyncio
+        return asyncio.run(self.engine.translate(texts, target))
+
+    async def translate_many_async(self, texts, target):
+        return await self.engine.translate(texts, target)
+
+    def supported_languages(self):
+        return self.engine.languages()
+
+    def close(self):
+        self.engine.close()
+
+    def retry_after(self, error):
+        if isinstance(error, RestApiError):
+            if is_temporary_error(error.status, error.content):
+                return parse_retry_after(error.retry_after)
+            return None
+        return TranslationProvider.retry_after(self, error)
+
+
+class RestApiError(Exception):
+
+    def __init__(self, status, content, retry_after=None):
+        Exception.__init__(self, "Translate API error %d: %s" % (status, content))
+        self.status = status
+        self.content = content
+        self.retry_after = retry_after
+
+
+class AsyncTranslateEngine(object):
+    """
+    asyncio engine for the Translate REST API.
+    The requests are sent by a pool of threads over a pool of keep-alive connections, so there are never
+    more than max_in_flight requests at the same time for the whole run, and the connections are reused by
+    all the requests instead of being opened again.
+    """
+
+    def __init__(self, api_key, endpoint=TRANSLATE_ENDPOINT, max_in_flight=MAX_IN_FLIGHT, timeout=60):
+        """
+        :param api_key:
+        :param endpoint: translate url, it can point to a local server for tests
+        :param max_in_flight: maximum number of requests at the same time
+        :param timeout: seconds
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from urllib.parse import urlparse
+        import queue
+        self.api_key = api_key
+        url = urlparse(endpoint)
+        self.https = url.scheme == 'https'
+        self.host = url.netloc
+        self.path = url.path or '/'
+        self.timeout = timeout
+        self.connection_count = 0
+        self._pool = queue.LifoQueue()
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    def _new_connection(self):
+        import http.client
+        self.connection_count += 1
+        if self.https:
+            return http.client.HTTPSConnection(self.host, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, timeout=self.timeout)
+
+    def _post(self, body, path=None):
+        """
+        Send the request with a pooled connection. Blocking, it runs at the engine threads.
+        :param body: url encoded form
+        :param path: url path, the translate endpoint by default
+        :return status, retry_after, content:
+        """
+        import http.client
+        import queue
+        try:
+            connection = self._pool.get_nowait()
+            reused = True
+        except queue.Empty:
+            connection = self._new_connection()
+            reused = False
+        while True:
+            try:
+                connection.request('POST', path or self.path, body, {'Content-Type': 'application/x-www-form-urlencoded'})
+                response = connection.getresponse()
+                content = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                # A pooled connection may have been closed by the server while idle, try once with a new one
+                if not reused:
+                    raise
+                connection = self._new_connection()
+                reused = False
+        if response.will_close:
+            connection.close()
+        else:
+            self._pool.put(connection)
+        return response.status, response.getheader('Retry-After'), content
+
+    async def translate(self, texts, target):
+        """
+        Translate a batch of texts.
+        :param texts: list of sentences
+        :param target: target language
+        :return translated_list: the translations in the same order of the texts
+        """
+        import asyncio
+        from urllib.parse import urlencode
+        body = urlencode([('key', self.api_key), ('target', target)] + [('q', text) for text in texts])
+        loop = asyncio.get_running_loop()
+        status, retry_after, content = await loop.run_in_executor(self._executor, self._post, body)
+        if status != 200:
+            raise RestApiError(status, content.decode('utf-8', 'replace'), retry_after)
+        translations = json.loads(content.decode('utf-8'))['data']['translations']
+        # The translations are HTML, like the values, with the text escaped
+        return [translation['translatedText'] for translation in translations]
+
+    def languages(self):
+        """
+        Get the supported target languages. Blocking.
+        :return language_list: list of language codes
+        """
+        from urllib.parse import urlencode
+        status, retry_after, content = self._post(urlencode([('key', self.api_key)]),
+                                                  self.path.rstrip('/') + '/languages')
+        if status != 200:
+            raise RestApiError(status, content.decode('utf-8', 'replace'), retry_after)
+        return [language['language'] for language in json.loads(content.decode('utf-8'))['data']['languages']]
+
+    def close(self):
+        self._executor.shutdown()
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+
+
+def is_temporary_error(status, content):
+    """
+    Check if a Translate API error is temporary.
+    :param status: http status
+    :param content: error content
+    :return temporary:
+    """
+    if isinstance(content, bytes):
+        content = content.decode('utf-8', 'replace')
+    # Quota errors come as 403 with the reason at the error content
+    return status in RETRY_STATUS or (status == 403 and any(reason in content for reason in RATE_LIMIT_REASONS))
+
+
+def parse_retry_after(value):
+    """
+    Parse the Retry-After header, given in seconds or as an http date.
+    :param value: header value, or None
+    :return seconds:
+    """
+    if not value:
+        return 0
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    import email.utils
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+class FakeProvider(TranslationProvider):
+    """
+    Offline deterministic backend, to test and benchmark the translation pipeline without network access.
+    Each text is translated to itself prefixed by the target language, after a configurable latency.
+    """
+
+    name = 'fake'
+
+    def __init__(self, settings):
+        """
+        :param settings: translate section of the settings file
+        """
+        # Seconds spent on each request
+        self.latency = settings.getfloat('fake_latency', 0)
+        # Probability of a request failing with a rate limit error, to test the retries
+        self.error_rate = settings.getfloat('fake_error_rate', 0)
+        self._random = random.Random(0)
+
+    def translate_many(self, texts, target):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and self._random.random() < self.error_rate:
+            raise FakeRateLimitError("Fake rate limit exceeded")
+        return ['[' + target + '] ' + text for text in texts]
+
+    def retry_after(self, error):
+        if isinstance(error, FakeRateLimitError):
+            return 0
+        return TranslationProvider.retry_after(self, error)
+
+
+class FakeRateLimitError(Exception):
+    pass
+
+
+# Translation backends available at the provider option of the settings file
+PROVIDERS = {
+    'google': GoogleTranslateProvider,
+    'google-rest': RestTranslateProvider,
+    'fake': FakeProvider,
+}
+
+
+def read_settings(settings_path=SETTINGS_FILE):
+    """
+    Read the settings file.
+    :param settings_path:
+    :return config: ConfigParser, always with a translate section
+    """
+    import configparser
+    config = configparser.ConfigParser()
+    config.read(settings_path)
+    if not config.has_section('translate'):
+        config.add_section('translate')
+    return config
+
+
+def get_provider_class(settings):
+    """
+    :param settings: translate section of the settings file
+    :return provider_class: TranslationProvider subclass chosen at the settings
+    """
+    provider_name = settings.get('provider', 'google')
+    if provider_name not in PROVIDERS:
+        raise ValueError("Unknown translation provider: " + provider_name)
+    return PROVIDERS[provider_name]
+
+
+def open_translation_memory(config, refresh=False):
+    """
+    :param config: settings
+    :param refresh: ignore the stored translations, but still store the new ones
+    :return memory: TranslationMemory at the path of the cache section of the settings
+    """
+    cache_path = config.get('cache', 'path', fallback=CACHE_FILE)
+    max_entries = config.getint('cache', 'max_entries', fallback=CACHE_MAX_ENTRIES)
+    return TranslationMemory(cache_path, max_entries, refresh)
+
+
+class TranslationClient(object):
+    """
+    Session-scoped translation client.
+    Load the settings and build the translation provider only once per run, so every string of every
+    locale reuses the same provider (for Google, the same service) instead of rereading the settings and
+    fetching the discovery document again.
+    """
+
+    def __init__(self, settings_path=SETTINGS_FILE, use_cache=True, refresh_cache=False, provider=None,
+                 journal=None, max_chars=0, priority_list=None):
+        """
+        :param settings_path:
+        :param use_cache: use the translation memory
+        :param refresh_cache: ignore the translations stored at the translation memory
+        :param provider: TranslationProvider to be used instead of the one at the settings file
+        :param journal: Journal where the translations of the run are recorded, None to not record them
+        :param max_chars: maximum number of characters sent to the API by the session, 0 means no limit
+        :param priority_list: languages translated first, most important first
+        """
+        setup_start = time.time()
+        config = read_settings(settings_path)
+        settings = config['translate']
+        if provider is None:
+            provider = get_provider_class(settings)(settings)
+        self.provider = provider
+        self.journal = journal
+        self.memory = open_translation_memory(config, refresh_cache) if use_cache else None
+        # Requests per second allowed for the whole run, shared by all the translation workers
+        requests_per_second = settings.getfloat('requests_per_second', 0)
+        chars_per_100_seconds = settings.getfloat('chars_per_100_seconds', 0)
+        self.rate_limiter = RateLimiter(requests_per_second, chars_per_100_seconds)
+        self.max_retries = settings.getint('max_retries', MAX_RETRIES)
+        self.languages_path = config.get('cache', 'languages_path', fallback=LANGUAGES_FILE)
+        # Folders translated to their own language instead of sharing the translation of their group
+        self.language_overrides = dict(config.items('languages')) if config.has_section('languages') else {}
+        self._languages = None
+        self._languages_loaded = False
+        self._setup_time = time.time() - setup_start
+        self.request_count = 0
+        self.sent_chars = 0
+        self.saved_chars = 0
+        self.retry_count = 0
+        self.retry_time = 0
+        self.invalid_count = 0
+        # Character budget of the session, reserved by each language before it is translated
+        self.max_chars = max_chars
+        self.priority_list = priority_list or []
+        self.planned_chars = 0
+        self.skipped_list = []
+        self._lock = threading.Lock()
+
+    @property
+    def provider_name(self):
+        return self.provider.name
+
+    def count_request(self, chars):
+        with self._lock:
+            self.request_count += 1
+            self.sent_chars += chars
+
+    def count_retry(self, wait):
+        with self._lock:
+            self.retry_count += 1
+            self.retry_time += wait
+
+    def sort_languages(self, language_list):
+        """
+        Sort the languages by the priority list, the languages not at the list keep their order after the others.
+        The priority list can use the folder qualifiers (pt-rBR) or the languages (pt).
+        :param language_list:
+        :return language_list:
+        """
+        priority_dict = {}
+        for index, priority in enumerate(self.priority_list):
+            for code in (priority, encode_android_res_lang(priority)):
+                if code is not None:
+                    priority_dict.setdefault(code.lower(), index)
+        return sorted(language_list, key=lambda language: priority_dict.get(language.lower(), len(self.priority_list)))
+
+    def reserve_chars(self, chars):
+        """
+        Reserve characters from the budget.
+        :param chars:
+        :return reserved: False if they don't fit at the budget
+        """
+        with self._lock:
+            if self.max_chars and self.planned_chars + chars > self.max_chars:
+                return False
+            self.planned_chars += chars
+            return True
+
+    def count_invalid(self):
+        with self._lock:
+            self.invalid_count += 1
+
+    def count_saved_chars(self, chars):
+        with self._lock:
+            self.saved_chars += chars
+
+    def supported_languages(self):
+        """
+        Get the target languages supported by the provider, loaded only once per run.
+        :return language_dict: dictionary lowercase code:code, None if any language is accepted
+        """
+        if not self._languages_loaded:
+            language_list = load_supported_languages(self.provider, self.languages_path)
+            if language_list is not None:
+                self._languages = dict((language.lower(), language) for language in language_list)
+            self._languages_loaded = True
+        return self._languages
+
+    def close(self):
+        if self.memory is not None:
+            self.memory.close()
+        if self.journal is not None:
+            self.journal.close()
+        self.provider.close()
+
+    @property
+    def setup_time(self):
+        """
+        Time spent building the client, including the provider backend built on the first request.
+        :return seconds:
+        """
+        return self._setup_time + self.provider.setup_time
+
+    def saved_setup_time(self):
+        """
+        Estimate of the setup time saved by reusing the client instead of building it for each request.
+        :return seconds:
+        """
+        return self.setup_time * max(self.request_count - 1, 0)
+
+
+def load_supported_languages(provider, languages_path=LANGUAGES_FILE, max_age=LANGUAGES_MAX_AGE):
+    """
+    Get the target languages supported by the provider from the languages file, fetching them again when
+    they are older than max_age. If they can't be fetched, the old ones are used.
+    :param provider: TranslationProvider
+    :param languages_path: file where the languages of each provider are kept
+    :param max_age: seconds
+    :return language_list: list of language codes, None if any language is accepted
+    """
+    cache = {}
+    try:
+        with open(languages_path) as languages_file:
+            cache = json.load(languages_file)
+    except (IOError, ValueError):
+        pass
+    entry = cache.get(provider.name)
+    if entry is not None and time.time() - entry['fetched'] < max_age:
+        return entry['languages']
+    try:
+        language_list = provider.supported_languages()
+    except Exception as e:
+        print("Couldn't get the supported languages: " + (str(e) or e.__class__.__name__))
+        return entry['languages'] if entry is not None else None
+    if language_list is None:
+        return None
+    cache[provider.name] = {'fetched': time.time(), 'languages': language_list}
+    write_file_atomically(languages_path, json.dumps(cache, indent=1, sort_keys=True) + '\n')
+    return language_list
+
+
+class TranslationMemory(object):
+    """
+    Persistent translation memory stored in a SQLite file.
+    The translations are keyed by the source text hash, the target language and the provider. When the
+    memory grows over max_entries the least recently used translations are evicted.
+    """
+
+    def __init__(self, path, max_entries=CACHE_MAX_ENTRIES, refresh=False):
+        """
+        :param path: SQLite file path
+        :param max_entries: maximum number of translations kept, 0 means no limit
+        :param refresh: ignore the stored translations, but still store the new ones
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        import sqlite3
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS translation ('
+            'source_hash TEXT, language TEXT, provider TEXT, translated TEXT, last_used REAL, '
+            'PRIMARY KEY (source_hash, language, provider))')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS translation_last_used ON translation (last_used)')
+        self._connection.commit()
+
+    @staticmethod
+    def source_hash(source):
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    def get_many(self, sources, language, provider):
+        """
+        Get the stored translations of the sources.
+        :param sources: list of sentences
+        :param language:
+        :param provider:
+        :return translated_dict: dictionary source:translation with only the found sources
+        """
+        unique_list = list(set(sources))
+        translated_dict = {}
+        if not self.refresh:
+            with self._lock:
+                for source in unique_list:
+                    row = self._connection.execute(
+                        'SELECT translated FROM translation WHERE source_hash = ? AND language = ? AND provider = ?',
+                        (self.source_hash(source), language, provider)).fetchone()
+                    if row is not None:
+                        translated_dict[source] = row[0]
+                # Mark the found translations as recently used
+                now = time.time()
+                self._connection.executemany(
+                    'UPDATE translation SET last_used = ? WHERE source_hash = ? AND language = ? AND provider = ?',
+                    [(now, self.source_hash(source), language, provider) for source in translated_dict])
+                self._connection.commit()
+        with self._lock:
+            self.hits += len(translated_dict)
+            self.misses += len(unique_list) - len(translated_dict)
+        return translated_dict
+
+    def put_many(self, translated_dict, language, provider):
+        """
+        Store the translations, evicting the least recently used ones if the memory is full.
+        :param translated_dict: dictionary source:translation
+        :param language:
+        :param provider:
+        :return:
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO translation VALUES (?, ?, ?, ?, ?)',
+                [(self.source_hash(source), language, provider, translated, now)
+                 for source, translated in translated_dict.items()])
+            if self.max_entries:
+                count = self._connection.execute('SELECT COUNT(*) FROM translation').fetchone()[0]
+                if count > self.max_entries:
+                    self._connection.execute(
+                        'DELETE FROM translation WHERE rowid IN '
+                        '(SELECT rowid FROM translation ORDER BY last_used LIMIT ?)', (count - self.max_entries,))
+                    self.evictions += count - self.max_entries
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class TokenBucket(object):
+    """
+    Token bucket refilled at a constant rate. The tokens can be reserved in advance, so concurrent callers
+    are served in order instead of racing for the same tokens.
+    """
+
+    def __init__(self, rate, capacity):
+        """
+        :param rate: tokens added per second
+        :param capacity: maximum tokens accumulated while idle
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_time = time.time()
+
+    def reserve(self, amount):
+        """
+        Take the tokens, even if they are not available yet. Not thread safe, the caller holds the lock.
+        :param amount:
+        :return wait: seconds until the reserved tokens are available
+        """
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+        self.tokens -= amount
+        return max(-self.tokens / self.rate, 0)
+
+
+class Journal(object):
+    """
+    Append-only journal of the translations done by a run, one JSON line per translated sentence and language.
+    When a run is interrupted, the next one can resume it: the journal is replayed instead of translating
+    again the sentences already done.
+    """
+
+    def __init__(self, path=JOURNAL_FILE, resume=False):
+        """
+        :param path:
+        :param resume: load the journal of the interrupted run, otherwise it is started again
+        """
+        self.path = path
+        self.entries = {}
+        self.hits = 0
+        self._lock = threading.Lock()
+        if resume and os.path.exists(path):
+            with open(path, encoding='utf-8') as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line may be cut if the run was killed while writing it
+                        continue
+                    self.entries[(entry['language'], entry['source'])] = entry['translation']
+        self._file = open(path, 'a' if resume else 'w', encoding='utf-8')
+
+    def get_many(self, sources, language):
+        """
+        Get the translations recorded by the interrupted run.
+        :param sources: list of sentences
+        :param language:
+        :return translated_dict: dictionary source:translation with only the found sources
+        """
+        translated_dict = {}
+        for source in sources:
+            translation = self.entries.get((language, source))
+            if translation is not None:
+                translated_dict[source] = translation
+        with self._lock:
+            self.hits += len(translated_dict)
+        return translated_dict
+
+    def record(self, translated_dict, language):
+        """
+        Append the translations to the journal.
+        :param translated_dict: dictionary source:translation
+        :param language:
+        :return:
+        """
+        lines = ''.join(json.dumps({'language': language, 'source': source, 'translation': translation}) + '\n'
+                        for source, translation in translated_dict.items())
+        with self._lock:
+            self._file.write(lines)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def remove(self):
+        """
+        Remove the journal once the run finished and its changes were written.
+        :return:
+        """
+        self.close()
+        if os.path.exists(self.path):
+            remove(self.path)
+
+
+class RateLimiter(object):
+    """
+    Thread safe limiter shared by all the API requests of the run, respecting both the requests per
+    second and the characters per 100 seconds quotas.
+    """
+
+    def __init__(self, requests_per_second, chars_per_100_seconds=0):
+        """
+        :param requests_per_second: 0 means no limit
+        :param chars_per_100_seconds: 0 means no limit
+        """
+        self.request_bucket = None
+        self.char_bucket = None
+        if requests_per_second > 0:
+            self.request_bucket = TokenBucket(requests_per_second, max(requests_per_second, 1))
+        if chars_per_100_seconds > 0:
+            self.char_bucket = TokenBucket(chars_per_100_seconds / 100.0, chars_per_100_seconds)
+        self.throttled_time = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, chars=0):
+        """
+        Block until a new request with the given number of characters is allowed.
+        :param chars: characters sent by the request
+        :return waited: seconds waited
+        """
+        wait = self.reserve(chars)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def reserve(self, chars=0):
+        """
+        Reserve a new request with the given number of characters, without waiting for it.
+        :param chars: characters sent by the request
+        :return wait: seconds to wait before sending the request
+        """
+        wait = 0
+        with self._lock:
+            if self.request_bucket is not None:
+                wait = self.request_bucket.reserve(1)
+            if self.char_bucket is not None:
+                wait = max(wait, self.char_bucket.reserve(chars))
+            self.throttled_time += wait
+        return wait
+
+
+class Metrics(object):
+    """
+    Thread safe timers and counters of the run, saved as JSON or as OpenMetrics text so the throughput and
+    the cost of the runs can be tracked over time.
+    The per language times are added up, so with several jobs their sum is bigger than the elapsed time.
+    """
+
+    def __init__(self):
+        self.phase_times = OrderedDict()
+        self.language_times = OrderedDict()
+        self.latencies = []
+        self.counters = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, phase, language=None):
+        """
+        Time the block and add its time to the phase.
+        :param phase: eg. config_load, base_parse, translate, file_rewrite
+        :param language: language the time is added to as well, None to add it only to the phase
+        :return:
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start, language)
+
+    def add_time(self, phase, seconds, language=None):
+        with self._lock:
+            self.phase_times[phase] = self.phase_times.get(phase, 0) + seconds
+            if language is not None:
+                self.language_times[language] = self.language_times.get(language, 0) + seconds
+
+    @contextmanager
+    def latency_timer(self):
+        """
+        Time an API request, failed or not.
+        :return:
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_latency(time.perf_counter() - start)
+
+    def observe_latency(self, seconds):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def latency_percentile(self, percent):
+        """
+        Nearest rank percentile of the API latencies.
+        :param percent: 0 to 100
+        :return seconds: None if no request was sent
+        """
+        with self._lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        rank = max(int(-(-percent * len(latencies) // 100)), 1)
+        return latencies[rank - 1]
+
+    def set_counters(self, **counters):
+        with self._lock:
+            self.counters.update(counters)
+
+    def to_dict(self):
+        """
+        :return metrics: dictionary ready to be saved as JSON
+        """
+        with self._lock:
+            latencies = list(self.latencies)
+            result = {
+                'phases': dict(self.phase_times),
+                'languages': dict(self.language_times),
+                'counters': dict(self.counters),
+            }
+        result['api_latency'] = OrderedDict([('count', len(latencies)), ('sum', sum(latencies))])
+        for percent in LATENCY_PERCENTILES:
+            result['api_latency']['p%d' % percent] = self.latency_percentile(percent)
+        return result
+
+    def to_openmetrics(self, prefix='translate'):
+        """
+        :param prefix: prefix of the metric names
+        :return text: metrics at the OpenMetrics text format
+        """
+        data = self.to_dict()
+        lines = ['# TYPE %s_phase_seconds gauge' % prefix]
+        for phase, seconds in sorted(data['phases'].items()):
+            lines.append('%s_phase_seconds{phase="%s"} %r' % (prefix, phase, seconds))
+        lines.append('# TYPE %s_language_seconds gauge' % prefix)
+        for language, seconds in sorted(data['languages'].items()):
+            lines.append('%s_language_seconds{language="%s"} %r' % (prefix, language, seconds))
+        lines.append('# TYPE %s_api_latency_seconds summary' % prefix)
+        for percent in LATENCY_PERCENTILES:
+            seconds = data['api_latency']['p%d' % percent]
+            if seconds is not None:
+                lines.append('%s_api_latency_seconds{quantile="%s"} %r' % (prefix, percent / 100.0, seconds))
+        lines.append('%s_api_latency_seconds_sum %r' % (prefix, data['api_latency']['sum']))
+        lines.append('%s_api_latency_seconds_count %d' % (prefix, data['api_latency']['count']))
+        for name, value in sorted(data['counters'].items()):
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            lines.append('%s_%s_total %r' % (prefix, name, value))
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of the current run
+metrics = Metrics()
+
+
+class ResourceIndex(object):
+    """
+    Index of the keys of the language files of a resource folder. The index is saved next to the resources,
+    and the entry of a file is only parsed again when the file size or modification time change, so checking
+    if a key exists at a language file doesn't need to read the file.
+    """
+
+    def __init__(self, base_path):
+        self.index_path = os.path.join(base_path, INDEX_FILE)
+        self.entries = {}
+        self.dirty = False
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path) as index_file:
+                    self.entries = json.load(index_file)
+            except ValueError:
+                # A corrupt index is just built again
+                self.entries = {}
+
+    def get_keys(self, file_path):
+        """
+        Get the keys of a resource file, parsing it only if it changed since it was indexed.
+        :param file_path:
+        :return key_set: set of keys, empty if the file doesn't exist
+        """
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return set()
+        name = os.path.relpath(file_path, os.path.dirname(self.index_path))
+        entry = self.entries.get(name)
+        if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+            with open(file_path, 'rb') as resource_file:
+                entry = {'mtime': stat.st_mtime, 'size': stat.st_size, 'keys': index_resources(resource_file.read())}
+            self.entries[name] = entry
+            self.dirty = True
+        return set(entry['keys'])
+
+    def save(self):
+        if self.dirty:
+            write_file_atomically(self.index_path, json.dumps(self.entries, separators=(',', ':')))
+            self.dirty = False
+
+
+def index_resources(data):
+    """
+    Index the keys of the resources of a file, working over the raw bytes so the values are not decoded.
+    :param data: file content
+    :return key_list: list of keys
+    """
+    key_list = []
+    for match in RESOURCE_BYTES_PATTERN.finditer(data):
+        if match.group('name') is None:
+            continue
+        name = match.group('name').decode('utf-8')
+        tag = match.group('tag').decode('ascii')
+        content = match.group('content') or b''
+        if tag == 'string':
+            key_list.append(name)
+            continue
+        for index, item_match in enumerate(ITEM_BYTES_PATTERN.finditer(content)):
+            if tag == 'plurals':
+                quantity = QUANTITY_BYTES_PATTERN.search(item_match.group('attributes'))
+                index = quantity.group(1).decode('ascii') if quantity else str(index)
+            key_list.append(make_key(name, tag, index))
+    return key_list
+
+
+def build_report(base_path_list, ignored_language_list):
+    """
+    Compare the language files with the base file of each resource folder, without any translation request.
+    Each file is parsed at most once, and the language files only if they changed since they were indexed.
+    :param base_path_list: resource folders
+    :param ignored_language_list:
+    :return report: dictionary with the language, missing, stale (changed at the base file since the last
+    incremental run) and extra keys of each language folder, the characters to be translated and the totals.
+    The folders are keyed by their qualifiers, since several folders (values-es, values-es-rMX) may resolve to
+    the same language
+    """
+    module_list = []
+    totals = {'missing': 0, 'stale': 0, 'extra': 0, 'characters': 0}
+    for base_path in base_path_list:
+        index = ResourceIndex(base_path)
+        # The keys left out of the base strings are not extra keys of the language files
+        skipped_list = []
+        base_dict = read_resources(base_path + '/values/strings.xml', skipped_list)
+        base_key_set = set(base_dict).union(skipped_list)
+        manifest = load_manifest(base_path) or {}
+        # Without a manifest there is no way to know what changed
+        stale_list = [key for key, value in base_dict.items() if key in manifest and manifest[key] != fingerprint(value)]
+        folder_dict = OrderedDict()
+        for path, language in sorted(get_language_paths(base_path, ignored_language_list)):
+            key_set = index.get_keys(path + 'strings.xml')
+            missing_list = [key for key in base_dict if key not in key_set]
+            language_stale_list = [key for key in stale_list if key in key_set]
+            extra_list = sorted(key for key in key_set if key not in base_key_set)
+            characters = sum(len(base_dict[key]) for key in missing_list + language_stale_list)
+            qualifiers = path.strip('/').split('/')[-1].split('-', 1)[1]
+            folder_dict[qualifiers] = {
+                'language': language,
+                'path': path,
+                'missing': missing_list,
+                'stale': language_stale_list,
+                'extra': extra_list,
+                'characters': characters,
+            }
+            totals['missing'] += len(missing_list)
+            totals['stale'] += len(language_stale_list)
+            totals['extra'] += len(extra_list)
+            totals['characters'] += characters
+        index.save()
+        module_list.append({'path': base_path, 'strings': len(base_dict), 'folders': folder_dict})
+    return {'modules': module_list, 'totals': totals}
+
+
+def print_report(report, cost_per_million_chars):
+    """
+    Print the report as a table.
+    :param report: see build_report
+    :param cost_per_million_chars: price of the translation API
+    :return:
+    """
+    row_format = "%-40s %-10s %8s %8s %8s %12s"
+    print(row_format % ("Folder", "Language", "Missing", "Stale", "Extra", "Characters"))
+    for module in report['modules']:
+        for qualifiers, result in module['folders'].items():
+            name = 'values-' + qualifiers
+            if len(report['modules']) > 1:
+                name = module['path'] + ' ' + name
+            print(row_format % (name, result['language'], len(result['missing']), len(result['stale']),
+                                len(result['extra']), result['characters']))
+    totals = report['totals']
+    print(row_format % ("Total", "", totals['missing'], totals['stale'], totals['extra'], totals['characters']))
+    print("Estimated cost: $%.2f (%d characters at $%s per million)" %
+          (totals['characters'] * cost_per_million_chars / 1000000.0, totals['characters'], cost_per_million_chars))
+
+
+def export_bundle(bundle_path, module_list, ignored_language_list, source_language=SOURCE_LANGUAGE):
+    """
+    Export the strings to be translated of every language file, to be translated out of the API.
+    Each row is written as soon as it is found, so the memory doesn't grow with the number of rows.
+    :param bundle_path: XLIFF 1.2 file if the extension is .xlf or .xliff, CSV file otherwise
+    :param module_list: list of (base_path, string_dict, removed_list, base_dict) of each module, see translate_files
+    :param ignored_language_list:
+    :param source_language: language of the base strings
+    :return count: number of strings exported
+    """
+    rows = get_pending_rows(module_list, ignored_language_list)
+    with open(bundle_path, 'w', encoding='utf-8', newline='') as bundle_file:
+        if bundle_path.lower().endswith(XLIFF_EXTENSIONS):
+            return write_xliff(bundle_file, rows, source_language)
+        return write_csv(bundle_file, rows)
+
+
+def get_pending_rows(module_list, ignored_language_list):
+    """
+    Get the strings to be translated of every language file, the empty array items and the references to other
+    resources are left out.
+    :param module_list: see translate_files
+    :param ignored_language_list:
+    :return rows: generator of (file path, language, key, source)
+    """
+    for base_path, string_dict, removed_list, base_dict in module_list:
+        index = ResourceIndex(base_path)
+        for path, language in sorted(get_language_paths(base_path, ignored_language_list)):
+            for key, value in add_missing_strings(index, path, string_dict, base_dict).items():
+                if value and not is_reference(value):
+                    yield path + 'strings.xml', language, key, value
+        index.save()
+
+
+def write_xliff(bundle_file, rows, source_language):
+    """
+    Write the rows as XLIFF 1.2, with a file element for each language file.
+    :param bundle_file:
+    :param rows: iterable of (file path, language, key, source), grouped by file
+    :param source_language:
+    :return count: number of rows
+    """
+    bundle_file.write('<?xml version="1.0" encoding="UTF-8"?>\n<xliff version="1.2" xmlns="%s">\n' % XLIFF_NAMESPACE)
+    count = 0
+    current_path = None
+    for file_path, language, key, source in rows:
+        if file_path != current_path:
+            if current_path is not None:
+                bundle_file.write('    </body>\n  </file>\n')
+            bundle_file.write('  <file original="%s" source-language="%s" target-language="%s" datatype="plaintext">\n'
+                              '    <body>\n' % (html.escape(file_path), html.escape(source_language),
+                                                  html.escape(language)))
+            current_path = file_path
+        bundle_file.write('      <trans-unit id="%s" xml:space="preserve">\n        <source>%s</source>\n'
+                          '      </trans-unit>\n' % (html.escape(key), html.escape(source)))
+        count += 1
+    if current_path is not None:
+        bundle_file.write('    </body>\n  </file>\n')
+    bundle_file.write('</xliff>\n')
+    return count
+
+
+def write_csv(bundle_file, rows):
+    """
+    Write the rows as CSV, with an empty target column to be filled.
+    :param bundle_file:
+    :param rows: iterable of (file path, language, key, source)
+    :return count: number of rows
+    """
+    import csv
+    writer = csv.writer(bundle_file)
+    writer.writerow(CSV_COLUMNS)
+    count = 0
+    for file_path, language, key, source in rows:
+        writer.writerow([file_path, language, key, source, ''])
+        count += 1
+    return count
+
+
+def read_bundle(bundle_path):
+    """
+    Read the rows of a translated bundle one by one, without loading the whole file.
+    :param bundle_path: XLIFF 1.2 file if the extension is .xlf or .xliff, CSV file otherwise
+    :return rows: generator of (file path, language, key, source, target)
+    """
+    if bundle_path.lower().endswith(XLIFF_EXTENSIONS):
+        from xml.etree.ElementTree import iterparse
+        file_path = None
+        language = None
+        # The elements already read are removed from their parents, clearing them would still keep them at the
+        # tree, so the memory doesn't grow with the number of rows
+        parent_list = []
+        for event, element in iterparse(bundle_path, events=('start', 'end')):
+            tag = element.tag.split('}')[-1]
+            if event == 'start':
+                if tag == 'file':
+                    file_path = element.get('original')
+                    language = element.get('target-language')
+                parent_list.append(element)
+                continue
+            parent_list.pop()
+            if tag == 'trans-unit':
+                source = element.find('{%s}source' % XLIFF_NAMESPACE)
+                target = element.find('{%s}target' % XLIFF_NAMESPACE)
+                yield (file_path, language, element.get('id'),
+                       ''.join(source.itertext()) if source is not None else None,
+                       ''.join(target.itertext()) if target is not None else None)
+            if tag in ('trans-unit', 'file') and parent_list:
+                parent_list[-1].remove(element)
+    else:
+        import csv
+        with open(bundle_path, encoding='utf-8', newline='') as bundle_file:
+            for row in csv.DictReader(bundle_file):
+                yield row['file'], row['language'], row['key'], row['source'], row['target']
+
+
+def import_bundle(bundle_path, verbose, stage=None, memory=None, provider_name=None):
+    """
+    Apply the translations of a bundle exported by export_bundle and translated out of the API, through the
+    same file update of the translations. The rows are applied file by file as they are read, so only the
+    translations of one file are kept in memory when the rows are grouped by file, as they are exported.
+    The rows without target, whose source changed at the base file since the export or whose translation
+    changed the placeholders or the markup are skipped. The references to other resources are not exported, so
+    the reference items of the translated string arrays are copied from the base array.
+    :param bundle_path:
+    :param verbose:
+    :param stage: FileStage where the new files are staged, None to write them right away
+    :param memory: TranslationMemory where the imported translations are stored, None to not store them
+    :param provider_name: provider whose translations the memory gives, see TranslationClient
+    :return counts, done_dict: dictionary with the number of imported, stale and invalid rows, and dictionary
+    base path:{key:source} of the strings imported at every row of the bundle, to be saved at the manifest
+    """
+    counts = {'imported': 0, 'stale': 0, 'invalid': 0}
+    base_dicts = {}
+    done_dict = OrderedDict()
+    skipped_set = set()
+    file_path = None
+    base_dict = None
+    translated_dict = {}
+    memory_dict = {}
+
+    def apply(language):
+        update_file(file_path, add_array_references(translated_dict, base_dict), verbose, stage=stage)
+        if memory is not None:
+            memory.put_many(memory_dict, language, provider_name)
+
+    language = None
+    for row_path, row_language, key, source, target in read_bundle(bundle_path):
+        if row_path != file_path:
+            if translated_dict:
+                apply(language)
+            file_path = row_path
+            language = row_language
+            translated_dict = {}
+            memory_dict = {}
+        folder_path = os.path.dirname(os.path.normpath(row_path))
+        # Only language files can be changed by a bundle
+        if os.path.basename(row_path) != 'strings.xml' or not os.path.basename(folder_path).startswith('values-'):
+            raise ValueError("Not a language file: " + row_path)
+        base_path = os.path.dirname(folder_path)
+        if base_path not in base_dicts:
+            base_dicts[base_path] = get_string_dict(base_path)
+            done_dict[base_path] = OrderedDict()
+        base_dict = base_dicts[base_path]
+        if not target:
+            skipped_set.add((base_path, key))
+            continue
+        if base_dict.get(key) != source:
+            print("Skipped " + key + " of " + row_path + ": the base string changed since the export")
+            counts['stale'] += 1
+            skipped_set.add((base_path, key))
+            continue
+        error = check_translation(source, target)
+        if error is not None:
+            print("Flagged " + key + " of " + row_path + ": " + error)
+            counts['invalid'] += 1
+            skipped_set.add((base_path, key))
+            continue
+        translated_dict[key] = target
+        memory_dict[source] = target
+        done_dict[base_path][key] = source
+        counts['imported'] += 1
+    if translated_dict:
+        apply(language)
+    # A string is only done when none of its languages was skipped
+    for base_path, key in skipped_set:
+        done_dict[base_path].pop(key, None)
+    return counts, done_dict
+
+
+def add_array_references(translated_dict, base_dict):
+    """
+    Add the items of the base string arrays that are empty or references to other resources, to the translated
+    arrays. They are not exported, and without them a string array rewritten with the imported items would lose
+    them and shift the indices of the next items.
+    :param translated_dict: dictionary key:translated text
+    :param base_dict: all the base strings
+    :return translated_dict:
+    """
+    name_set = set(split_key(key)[0] for key in translated_dict if split_key(key)[1] == 'string-array')
+    for key, value in base_dict.items():
+        if key not in translated_dict and (not value or is_reference(value)) and split_key(key)[0] in name_set:
+            translated_dict[key] = value
+    return translated_dict
+
+
+def translate_files(client, base_path, string_dict, ignored_language_list, verbose, jobs=1, removed_list=None,
+                    base_dict=None, stage=None):
     """
     Translate all localization files available at base path, based on the values
     passed at string_dict dictionary.
+    A failure in a language is reported without stopping the translation of the other ones.
+    :param client: TranslationClient shared by all the languages
     :param base_path:
     :param string_dict:
-    :return string_dict:
+    :param ignored_language_list:
+    :param verbose:
+    :param jobs: number of languages translated at the same time
+    :param removed_list: keys to be removed from the language files
+    :param base_dict: all the base strings, to also translate the ones missing at each language file
+    :param stage: FileStage where the new files are staged, None to write them right away
+    :return failed_list: list of (language, error) pairs of the languages that failed
+    """
+    language_paths = get_language_paths(base_path, ignored_language_list, client.supported_languages(),
+                                        client.language_overrides)
+    index = ResourceIndex(base_path)
+    # The regional variants with the same target language (values-es and values-es-rMX) are translated once
+    group_dict = OrderedDict()
+    for path, language in language_paths:
+        group_dict.setdefault(language, []).append((path, add_missing_strings(index, path, string_dict, base_dict)))
+    index.save()
+    schedule = schedule_languages(client, OrderedDict(
+        (language, dedup_strings([string_dict for path, string_dict in file_list])[0])
+        for language, file_list in group_dict.items()))
+    arguments_list = [(client, group_dict[language], language, verbose, removed_list, stage, pending)
+                      for language, pending in schedule]
+    error_list = run_jobs(translate_language, arguments_list, jobs)
+    return [(language, error) for (language, pending), error in zip(schedule, error_list) if error]
+
+
+def add_missing_strings(index, path, string_dict, base_dict):
+    """
+    Add the base strings missing at a language file to the strings to be translated.
+    :param index: ResourceIndex of the base path
+    :param path: language folder
+    :param string_dict: strings to be translated
+    :param base_dict: all the base strings, None to not look for missing strings
+    :return language_dict: the strings to be translated for the language
+    """
+    if base_dict is None:
+        return string_dict
+    key_set = index.get_keys(path + 'strings.xml')
+    missing_list = [(key, value) for key, value in base_dict.items() if key not in key_set and key not in string_dict]
+    if not missing_list:
+        return string_dict
+    language_dict = OrderedDict(string_dict)
+    language_dict.update(missing_list)
+    return language_dict
+
+
+def get_language_paths(base_path, ignored_language_list, supported_languages=None, language_overrides=None):
+    """
+    Get the language folders of the base path.
+    The folders that aren't languages (values-night, values-sw600dp...) or whose language isn't supported
+    are skipped.
+    :param base_path:
+    :param ignored_language_list: folder qualifiers or languages to be skipped
+    :param supported_languages: dictionary lowercase code:code of the provider, None to accept any language
+    :param language_overrides: dictionary lowercase folder qualifiers:language, used instead of the language
+    resolved from the qualifiers
+    :return language_paths: list of (folder path, language) pairs
     """
     paths = glob(base_path + '/values-*/')
 
     # Each path is a different language file
+    language_paths = []
     for path in paths:
-        # print(path)
-        # Get the language at folder name pattern
-        language = path.strip('/').split('/')[-1].split('-', 1)[1]
-        # Pass languages ignored and system folder
-        if language in ignored_language_list:
+        # Get the qualifiers at folder name pattern
+        qualifiers = path.strip('/').split('/')[-1].split('-', 1)[1]
+        if qualifiers in ignored_language_list:
+            continue
+        language = (language_overrides or {}).get(qualifiers.lower())
+        if language is None:
+            language = encode_android_res_lang(qualifiers, supported_languages)
+        # Pass languages ignored, unsupported and system folders
+        if language is None or language in ignored_language_list:
             continue
-        # Android resources use a pattern with format xx-rCC where xx in the language
-        # and CC is the country. But google translator API uses a format xx-cc
-        language = encode_android_res_lang(language)
-        print("Starting translation for " + language)
-        translate_file(string_dict, path, language, verbose)
-        print("--------------------------------------------")
+        language_paths.append((path, language))
+    return language_paths
 
 
-def translate_file(string_dict, path, language, verbose):
+def run_jobs(function, arguments_list, jobs):
     """
-    Translate the file and save it with translated version
-    :param string_dict:
-    :param path:
+    Call the function with each tuple of arguments, on a pool of threads when jobs is bigger than 1.
+    The function receives the stream where its output must be printed as the last argument. Each call
+    output is buffered and printed at once when it finishes, so it is not mixed up with the others.
+    :param function:
+    :param arguments_list: list of tuples of arguments
+    :param jobs: number of calls at the same time
+    :return result_list: the results in the same order of the arguments
+    """
+    if jobs <= 1:
+        return [function(*arguments) for arguments in arguments_list]
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    result_list = [None] * len(arguments_list)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for index, arguments in enumerate(arguments_list):
+            out = StringIO()
+            futures[executor.submit(function, *(tuple(arguments) + (out,)))] = (index, out)
+        for future in as_completed(futures):
+            index, out = futures[future]
+            print(out.getvalue(), end='')
+            result_list[index] = future.result()
+    return result_list
+
+
+def watch(client, base_path_list, ignored_language_list, verbose, jobs=1, interval=WATCH_INTERVAL,
+          dry_run=False, save_manifests=False):
+    """
+    Translate the strings added or changed at the base files each time they are saved, until interrupted.
+    The base files are polled, and the client (with its provider and translation memory) and the base strings
+    are kept between the changes, so only the changed strings are parsed from the language files and sent.
+    :param client: TranslationClient
+    :param base_path_list:
+    :param ignored_language_list:
+    :param verbose:
+    :param jobs: number of languages translated at the same time
+    :param interval: seconds between two checks of the base files
+    :param dry_run: print the diff of the changes instead of writing them
+    :param save_manifests: save the manifest of the incremental mode after each change
+    :return:
+    """
+    base_dicts = dict((base_path, get_string_dict(base_path)) for base_path in base_path_list)
+    stamps = dict((base_path, get_file_stamp(base_path + '/values/strings.xml')) for base_path in base_path_list)
+    print("Watching %d base files, press Ctrl+C to stop" % len(base_path_list))
+    try:
+        while True:
+            time.sleep(interval)
+            for base_path in base_path_list:
+                stamp = get_file_stamp(base_path + '/values/strings.xml')
+                if stamp == stamps[base_path]:
+                    continue
+                stamps[base_path] = stamp
+                try:
+                    base_dict = get_string_dict(base_path)
+                except (IOError, ValueError) as e:
+                    # The file may be saved again in a moment
+                    print("Can't read the base strings of " + base_path + ": " + str(e))
+                    continue
+                old_dict = base_dicts[base_path]
+                string_dict = OrderedDict((key, value) for key, value in base_dict.items()
+                                          if old_dict.get(key) != value)
+                removed_list = [key for key in old_dict if key not in base_dict]
+                if not string_dict and not removed_list:
+                    continue
+                print("%s: %d strings to translate, %d removed" % (base_path, len(string_dict), len(removed_list)))
+                stage = FileStage()
+                try:
+                    failed_list = translate_files(client, base_path, string_dict, ignored_language_list, verbose,
+                                                  jobs, removed_list, None, stage)
+                    for language, error in failed_list:
+                        print("Failed " + language + ": " + error)
+                    if dry_run:
+                        print(stage.diff(), end='')
+                    elif failed_list:
+                        # Not taken as done, so the strings are translated again at the next change
+                        print("No file changed because some languages failed")
+                        continue
+                    else:
+                        print("%d files changed" % stage.commit())
+                        if save_manifests and not client.skipped_list:
+                            save_manifest(base_path, base_dict)
+                    base_dicts[base_path] = base_dict
+                finally:
+                    stage.discard()
+    except KeyboardInterrupt:
+        print("Stopped watching")
+
+
+def get_file_stamp(file_path):
+    """
+    :param file_path:
+    :return stamp: modification time and size of the file, None if it doesn't exist
+    """
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def find_modules(root_path):
+    """
+    Find every resource folder (a folder with a values/strings.xml file) under the project root.
+    :param root_path:
+    :return path_list:
+    """
+    path_list = []
+    for dir_path, dir_names, file_names in os.walk(root_path):
+        if os.path.isfile(os.path.join(dir_path, 'values', 'strings.xml')):
+            path_list.append(dir_path)
+            # Resource folders are not nested
+            dir_names[:] = []
+            continue
+        # Skip hidden and generated folders, and walk the modules always in the same order
+        dir_names[:] = sorted(name for name in dir_names if name not in SCAN_IGNORED_DIRS and name[0] != '.')
+    return path_list
+
+
+def translate_modules(client, module_list, ignored_language_list, verbose, jobs=1, stage=None):
+    """
+    Translate several resource folders with a single translation plan. The unique values of all the
+    modules are translated once per language, then the language files of every module are updated.
+    A failure in a language or a file is reported without stopping the other ones.
+    :param client: TranslationClient
+    :param module_list: list of (base_path, string_dict, removed_list, base_dict) of each module, see translate_files
+    :param ignored_language_list:
+    :param verbose:
+    :param jobs: number of languages translated, and then files updated, at the same time
+    :param stage: FileStage where the new files are staged, None to write them right away
+    :return failed_list: list of (language or file, error) pairs of what failed
+    """
+    # Plan with the unique values to be translated to each language, across all the modules
+    plan = OrderedDict()
+    file_list = []
+    saved_chars = 0
+    for base_path, module_dict, removed_list, base_dict in module_list:
+        index = ResourceIndex(base_path)
+        for path, language in get_language_paths(base_path, ignored_language_list, client.supported_languages(),
+                                                 client.language_overrides):
+            string_dict = add_missing_strings(index, path, module_dict, base_dict)
+            value_dict = plan.setdefault(language, OrderedDict())
+            for value in string_dict.values():
+                if value in value_dict:
+                    saved_chars += len(value)
+                value_dict[value] = None
+            file_list.append((path, language, string_dict, removed_list))
+        index.save()
+    client.count_saved_chars(saved_chars)
+    print("Translation plan: %d languages, %d strings, %d files" %
+          (len(plan), sum(len(value_dict) for value_dict in plan.values()), len(file_list)))
+
+    failed_list = []
+    translation_dicts = {}
+    schedule = schedule_languages(client, OrderedDict((language, list(value_dict))
+                                                      for language, value_dict in plan.items()))
+    result_list = run_jobs(translate_plan_language,
+                           [(client, language, list(plan[language]), verbose, pending)
+                            for language, pending in schedule],
+                           jobs)
+    for (language, pending), (translation_dict, error) in zip(schedule, result_list):
+        if error:
+            failed_list.append((language, error))
+        else:
+            translation_dicts[language] = translation_dict
+
+    # The files of the failed and skipped languages are left as they are
+    file_list = [(path, language, string_dict, removed_list)
+                 for path, language, string_dict, removed_list in file_list if language in translation_dicts]
+    error_list = run_jobs(update_module_file,
+                          [(path, translation_dicts[language], string_dict, removed_list, verbose, stage)
+                           for path, language, string_dict, removed_list in file_list],
+                          jobs)
+    for (path, language, string_dict, removed_list), error in zip(file_list, error_list):
+        if error:
+            failed_list.append((path + "strings.xml", error))
+    return failed_list
+
+
+def translate_plan_language(client, language, value_list, verbose, pending=None, out=None):
+    """
+    Translate the values of a language of the translation plan.
+    :param client: TranslationClient
+    :param language:
+    :param value_list: unique values
+    :param verbose:
+    :param pending: values to be sent, see find_pending, None to find them now
+    :param out: stream where the output is printed, the standard output by default
+    :return translation_dict, error: dictionary value:translated value, and the error message or None
+    """
+    print("Starting translation for " + language, file=out)
+    try:
+        with metrics.timer('translate', language):
+            translation_dict = dict(zip(value_list, translate_many(client, value_list, language, pending)))
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+        print("Translation failed for " + language + ": " + error, file=out)
+        return None, error
+    if verbose:
+        print("%d strings translated." % len(value_list), file=out)
+    return translation_dict, None
+
+
+def update_module_file(path, translation_dict, string_dict, removed_list, verbose, stage=None, out=None):
+    """
+    Update a language file of a module with the translations of the plan.
+    :param path: language folder
+    :param translation_dict: dictionary value:translated value of the language
+    :param string_dict: strings of the module
+    :param removed_list: keys to be removed from the file
+    :param verbose:
+    :param stage: FileStage where the new file is staged, None to write it right away
+    :param out: stream where the output is printed, the standard output by default
+    :return error: the error message, None if the file was updated
+    """
+    translated_dict = get_translated_dict(string_dict, translation_dict, out)
+    try:
+        update_file(path + "strings.xml", translated_dict, verbose, out, removed_list, stage)
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+        print("Update failed for " + path + "strings.xml: " + error, file=out)
+        return error
+    return None
+
+
+def translate_language(client, file_list, language, verbose, removed_list=None, stage=None, pending=None,
+                       out=None):
+    """
+    Translate the files of a language, catching any error so it doesn't abort the other languages.
+    :param client: TranslationClient
+    :param file_list: list of (language folder, string_dict) pairs of the folders with this target language
+    :param language:
+    :param verbose:
+    :param removed_list: keys to be removed from the language file
+    :param stage: FileStage where the new file is staged, None to write it right away
+    :param pending: strings to be sent, see find_pending
+    :param out: stream where the output is printed, the standard output by default
+    :return error: the error message, None if the language was translated
+    """
+    print("Starting translation for " + language, file=out)
+    if len(file_list) > 1:
+        print("Shared by " + ", ".join(path.strip('/').split('/')[-1] for path, string_dict in file_list), file=out)
+    error = None
+    try:
+        translate_file(client, file_list, language, verbose, out, removed_list, stage, pending)
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+        print("Translation failed for " + language + ": " + error, file=out)
+    print("--------------------------------------------", file=out)
+    return error
+
+
+def translate_file(client, file_list, language, verbose, out=None, removed_list=None, stage=None, pending=None):
+    """
+    Translate the files of a language and save them with translated version
+    :param client: TranslationClient
+    :param file_list: list of (language folder, string_dict) pairs, all translated to the same language
     :param language:
     :param verbose:
+    :param out: stream where the output is printed, the standard output by default
+    :param removed_list: keys to be removed from the language files
+    :param stage: FileStage where the new files are staged, None to write them right away
+    :param pending: strings to be sent, see find_pending, None to find them now
     :return:
     """
+    # Identical values are translated only once and the translation is shared by all their keys and files
+    unique_list, saved_chars = dedup_strings([string_dict for path, string_dict in file_list])
+    client.count_saved_chars(saved_chars)
+    # All the strings of the language are sent together, split only by the API request limits
+    with metrics.timer('translate', language):
+        translation_dict = dict(zip(unique_list, translate_many(client, unique_list, language, pending)))
+    if verbose:
+        for value in unique_list:
+            print("%s => %s" % (value, translation_dict[value]), file=out)
+        print("Translation Finished.", file=out)
+
+    for path, string_dict in file_list:
+        translated_dict = get_translated_dict(string_dict, translation_dict, out)
+        update_file(path + "strings.xml", translated_dict, verbose, out, removed_list, stage)
+
+
+def get_translated_dict(string_dict, translation_dict, out=None):
+    """
+    Get the translation of each string. The strings whose translation was flagged as invalid are left out,
+    so the file keeps their old value.
+    :param string_dict:
+    :param translation_dict: dictionary value:translated value, None for the invalid translations
+    :param out: stream where the output is printed, the standard output by default
+    :return translated_dict: dictionary key:translated value
+    """
     translated_dict = {}
     for key, value in string_dict.items():
-        translated_value = translate(value, language)
-        translated_dict[key] = translated_value
-        if verbose:
-            print(value + " => " + translated_value)
+        if translation_dict[value] is None:
+            print("Flagged " + key + ": its translation changed the placeholders or the markup", file=out)
+            continue
+        translated_dict[key] = translation_dict[value]
+    return translated_dict
+
+
+def dedup_strings(string_dict_list):
+    """
+    Collapse the identical values of the strings of one or more files.
+    :param string_dict_list: list of string_dict
+    :return unique_list, saved_chars: the unique values in their first appearance order and the number
+    of characters that doesn't need to be translated
+    """
+    unique_list = []
+    seen = set()
+    saved_chars = 0
+    for string_dict in string_dict_list:
+        for value in string_dict.values():
+            if value in seen:
+                saved_chars += len(value)
+                continue
+            seen.add(value)
+            unique_list.append(value)
+    return unique_list, saved_chars
+
+
+def translate_many(client, sources, language, pending=None):
+    """
+    Translate a list of sentences with as few API requests as possible.
+    The translations are returned in the same order of the sources.
+    :param client: TranslationClient
+    :param sources: list of sentences
+    :param language:
+    :param pending: result of find_pending for these sources, None to find it now
+    :return translated_list: None for the translations that changed the placeholders or the markup
+    """
+    if pending is None:
+        pending = find_pending(client, sources, language)
+    cached_dict, pending_dict = pending
+    translated_dict = dict(cached_dict)
+
+    def store(batch, translation_list):
+        # Each batch is saved as soon as it arrives, so it is not lost if the run is interrupted
+        batch_dict = {}
+        for masked, translation in zip(batch, translation_list):
+            for source, placeholder_list in pending_dict[masked]:
+                # The invalid translations are neither saved nor written, so they are sent again at the next run
+                if check_placeholders(translation, placeholder_list) is not None:
+                    client.count_invalid()
+                    translated_dict[source] = None
+                    continue
+                batch_dict[source] = unmask_placeholders(translation, placeholder_list)
+        if client.memory is not None:
+            client.memory.put_many(batch_dict, language, client.provider_name)
+        if client.journal is not None:
+            client.journal.record(batch_dict, language)
+        translated_dict.update(batch_dict)
+
+    batches = list(make_batches(list(pending_dict)))
+    if client.provider.asynchronous and len(batches) > 1:
+        import asyncio
+        # All the batches are sent at the same time, the provider limits the requests in flight
+        asyncio.run(request_all_translations_async(client, batches, language, store))
+    else:
+        for batch in batches:
+            store(batch, request_translations(client, batch, language))
+
+    return [translated_dict[source] for source in sources]
+
+
+def find_pending(client, sources, language):
+    """
+    Find the sentences that must be sent to the API, before sending anything.
+    The ones found at the journal of the interrupted run or at the translation memory, the references to other
+    resources and the ones with nothing to translate besides the placeholders are not sent. The rest are
+    masked, so the translator can't change the placeholders and the markup, and identical masked sentences are
+    sent only once.
+    :param client: TranslationClient
+    :param sources: list of sentences
+    :param language:
+    :return translated_dict, pending_dict: dictionary source:translation of the sentences not sent, and ordered
+    dictionary masked sentence:list of (source, placeholder_list) of the sentences to be sent
+    """
+    translated_dict = client.journal.get_many(sources, language) if client.journal else {}
+    if client.memory is not None:
+        translated_dict.update(client.memory.get_many([source for source in sources if source not in translated_dict],
+                                                      language, client.provider_name))
+    pending_dict = OrderedDict()
+    for source in OrderedDict.fromkeys(sources):
+        if source in translated_dict:
+            continue
+        # References to other resources are not translated
+        if is_reference(source):
+            translated_dict[source] = source
+            continue
+        masked, placeholder_list = mask_placeholders(source)
+        if not PLACEHOLDER_PATTERN.sub('', masked).strip():
+            translated_dict[source] = source
+            continue
+        pending_dict.setdefault(masked, []).append((source, placeholder_list))
+    return translated_dict, pending_dict
+
+
+def schedule_languages(client, value_dict):
+    """
+    Plan the translation of several languages before sending anything. The languages are sorted by the
+    priority list of the client, and the characters each one will send are reserved from the character budget,
+    in order. Once a language doesn't fit at the budget, it and the languages after it are skipped, so the
+    most important languages are the ones translated.
+    :param client: TranslationClient
+    :param value_dict: dictionary language:list of unique values
+    :return schedule: list of (language, pending) pairs of the languages to be translated, see find_pending
+    """
+    schedule = []
+    over_budget = False
+    for language in client.sort_languages(list(value_dict)):
+        pending = find_pending(client, value_dict[language], language)
+        chars = sum(len(masked) for masked in pending[1])
+        # The languages fully translated by the translation memory don't spend anything
+        if chars and (over_budget or not client.reserve_chars(chars)):
+            over_budget = True
+            client.skipped_list.append((language, chars))
+            print("Skipping %s: its %d characters don't fit at the budget of %d" %
+                  (language, chars, client.max_chars))
+            continue
+        schedule.append((language, pending))
+    return schedule
+
+
+def request_translations(client, batch, language):
+    """
+    Send a batch to the provider, respecting the rate limit. Failures that the provider reports as
+    temporary (rate limit exceeded, server errors) are retried with exponential backoff and jitter,
+    waiting at least the time requested by the server.
+    :param client: TranslationClient
+    :param batch: list of sentences
+    :param language:
+    :return translated_list:
+    """
+    chars = sum(len(source) for source in batch)
+    attempt = 0
+    while True:
+        client.rate_limiter.acquire(chars)
+        client.count_request(chars)
+        try:
+            with metrics.latency_timer():
+                return client.provider.translate_many(batch, language)
+        except Exception as e:
+            wait = retry_wait(client, e, attempt)
+            time.sleep(wait)
+            attempt += 1
+
+
+async def request_translations_async(client, batch, language):
+    """
+    Same as request_translations, for the asynchronous providers.
+    :param client: TranslationClient
+    :param batch: list of sentences
+    :param language:
+    :return translated_list:
+    """
+    import asyncio
+    chars = sum(len(source) for source in batch)
+    attempt = 0
+    while True:
+        await asyncio.sleep(client.rate_limiter.reserve(chars))
+        client.count_request(chars)
+        try:
+            with metrics.latency_timer():
+                return await client.provider.translate_many_async(batch, language)
+        except Exception as e:
+            wait = retry_wait(client, e, attempt)
+            await asyncio.sleep(wait)
+            attempt += 1
+
+
+async def request_all_translations_async(client, batches, language, callback):
+    """
+    Send all the batches at the same time.
+    :param client: TranslationClient
+    :param batches: list of lists of sentences
+    :param language:
+    :param callback: function called with each batch and its translations as soon as they arrive
+    :return:
+    """
+    import asyncio
+
+    async def request(batch):
+        callback(batch, await request_translations_async(client, batch, language))
+
+    await asyncio.gather(*[request(batch) for batch in batches])
+
+
+def retry_wait(client, error, attempt):
+    """
+    Get the time to wait before retrying a failed request, raising the error again if it can't be retried.
+    :param client: TranslationClient
+    :param error: the exception raised by the provider
+    :param attempt: number of retries already done
+    :return wait: seconds
+    """
+    retry_after = client.provider.retry_after(error)
+    if retry_after is None or attempt >= client.max_retries:
+        raise error
+    # Full jitter backoff, so the concurrent workers don't retry at the same time
+    backoff = random.uniform(0, min(RETRY_MAX_BACKOFF, RETRY_BASE_BACKOFF * 2 ** attempt))
+    wait = max(retry_after, backoff)
+    client.count_retry(wait)
+    return wait
+
+
+def make_batches(sources, max_segments=MAX_SEGMENTS_PER_REQUEST, max_chars=MAX_CHARS_PER_REQUEST):
+    """
+    Split the sources in consecutive batches that respect the per request limits of the API.
+    A single source bigger than max_chars is sent alone in its own batch.
+    :param sources: list of sentences
+    :param max_segments: maximum number of q values per request
+    :param max_chars: maximum number of characters per request
+    :return batches: generator of lists of sentences
+    """
+    batch = []
+    batch_chars = 0
+    for source in sources:
+        if batch and (len(batch) >= max_segments or batch_chars + len(source) > max_chars):
+            yield batch
+            batch = []
+            batch_chars = 0
+        batch.append(source)
+        batch_chars += len(source)
+    if batch:
+        yield batch
+
+
+def update_file(file_path, translated_dict, verbose, out=None, removed_list=None, stage=None):
+    """
+    Rewrite the language file in a single pass. Each string, plurals and string-array element is looked up
+    by its exact name at the translated dictionary, the resources not found at the file are inserted at the
+    end, and everything else (comments, other resources, formatting) is copied as is.
+    The new content is written to a temporary file that replaces the original one at once, or that is kept
+    at the stage until all the files are ready. Files whose content doesn't change are not written, and a missing
+    file is created.
+    :param file_path:
+    :param translated_dict: dictionary key:translated text, with the keys of get_string_dict
+    :param verbose:
+    :param out: stream where the output is printed, the standard output by default
+    :param removed_list: keys to be removed from the file
+    :param stage: FileStage where the new file is staged, None to write it right away
+    :return:
+    """
+    print("Updating file: " + file_path, file=out)
+    # A file can be updated again before the stage is committed
+    old_content = stage.get_content(file_path) if stage is not None else None
+    if old_content is None:
+        try:
+            with open(file_path, encoding='utf-8') as text_file:
+                old_content = text_file.read()
+        except FileNotFoundError:
+            # A language folder without strings.xml gets a new one, as its strings are all missing
+            old_content = ''
+
+    with metrics.timer('file_rewrite'):
+        content, counts = rewrite_resources(old_content or RESOURCES_SKELETON, translated_dict, removed_list)
+
+    if content == (old_content or RESOURCES_SKELETON):
+        print("File unchanged.", file=out)
+        return
     if verbose:
-        print("Translation Finished.")
+        print("%d resources updated, %d inserted, %d removed" %
+              (counts['updated'], counts['inserted'], counts['removed']), file=out)
+    if stage is not None:
+        stage.add(file_path, old_content, content)
+        print("File Staged.", file=out)
+        return
+    write_file_atomically(file_path, content)
+    print("File Updated.", file=out)
 
-    file_path = path + "strings.xml"
-    update_file(file_path, translated_dict, verbose)
 
+def rewrite_resources(content, translated_dict, removed_list=None):
+    """
+    Apply the translations to the content of a resource file.
+    :param content:
+    :param translated_dict: dictionary key:translated text
+    :param removed_list: keys to be removed
+    :return content, counts: the new content and the number of updated, inserted and removed resources
+    """
+    # Group the items by resource, the values are encoded only once
+    pending_dict = OrderedDict()
+    for key, value in translated_dict.items():
+        name, tag, item = split_key(key)
+        pending_dict.setdefault(name, (tag, OrderedDict()))[1][item] = encode_android_value(value)
+    removed_dict = {}
+    for key in removed_list or []:
+        name, tag, item = split_key(key)
+        removed_dict.setdefault(name, set()).add(item)
 
-def translate(source, language):
-    # Use Google Translator API to translate teh sentence <http://code.google.com/apis/console>
-    config = configparser.ConfigParser()
-    config.read('project.settings')
-    api_key = config['translate']['api_key']
-    service = (build('translate', 'v2', developerKey=api_key))
-    request = service.translations().list(q=source, target=language)
-    response = request.execute()
-    # Escape some html entities that come with response AND Escape
-    # Apostrophe (needed for Android Resource xml files)
-    return html.unescape(response['translations'][0]['translatedText']).replace("'", "\\'")
-
-
-def update_file(file_path, translated_dict, verbose):
-    print("Updating file: " + file_path)
-    baseDoc = minidom.parse(file_path)
-    strings = baseDoc.getElementsByTagName("string")
-    translated_list_key = list(translated_dict.keys())
-    update_dict = {}
-    for string in strings:
-        # Push into the dictionary the pair of key value for string key and key value
-        if string.getAttribute("name") in translated_list_key:
-            update_key = string.getAttribute("name")
-            # Remove items
-            update_dict[update_key] = translated_dict[update_key]
-            del translated_dict[update_key]
-
-    # Select insert lines
-    # List with the items to be inserted
-    remaining_list = list(translated_dict.keys())
+    counts = {'updated': 0, 'inserted': 0, 'removed': 0}
+    indent = [DEFAULT_INDENT]
+
+    def rewrite(match):
+        name = match.group('name')
+        # Comments are copied as is, even if they contain resource tags
+        if name is None:
+            return match.group(0)
+        line_indent = match.group('indent') or ''
+        indent[0] = line_indent or indent[0]
+        if name not in pending_dict and name not in removed_dict:
+            return match.group(0)
+
+        tag, item_dict = pending_dict.pop(name, (match.group('tag'), {}))
+        open_tag = match.group('open')
+        if tag == match.group('tag'):
+            # Keep the items that are not translated now, and the attributes of the element
+            new_item_dict = get_resource_items(match)
+            new_item_dict.update(item_dict)
+        else:
+            open_tag = '<' + tag + ' name="' + name + '"'
+            new_item_dict = OrderedDict(item_dict)
+        for item in removed_dict.get(name, ()):
+            new_item_dict.pop(item, None)
+        if not new_item_dict or (tag == 'string' and None not in new_item_dict):
+            counts['removed'] += 1
+            return ''
+        counts['updated'] += 1
+        return line_indent + render_resource(open_tag, tag, new_item_dict, line_indent) + (match.group('newline') or '')
+
+    content = RESOURCE_PATTERN.sub(rewrite, content)
+
+    # Insert the new resources just before the end of the resources
     insert_lines = ''
-    for t_string in remaining_list:
-        new_line = ' <string name="' + t_string + '">' + translated_dict[t_string] + '</string>\n'
-        insert_lines += new_line
-
-    # UPDATE AND INSERT LINES
-    # List with items to be updated
-    update_list = list(update_dict.keys())
-    text_file = open(file_path, "r+")
-    for line in text_file:
-        # Check if the tag  is commented
-        if line.strip(' \t\n\r')[0:4] == '<!--':
-            print(line)
-            continue
-        # Insert New Lines
-        if insert_lines:
-            # Insert as soon as the first resource tag appears
-            if "<resources>" in line:
-                start_tag_line = line.strip(' \t\n\r')
-                new_lines = start_tag_line + "\n" + insert_lines
-                print(line.replace(line, new_lines))
-                #To stop running after first success
-                insert_lines = None
-                continue
+    for name, (tag, item_dict) in pending_dict.items():
+        insert_lines += indent[0] + render_resource('<' + tag + ' name="' + name + '"', tag, item_dict, indent[0]) + '\n'
+        counts['inserted'] += 1
+    if insert_lines:
+        end = content.rfind('</resources>')
+        if end < 0:
+            raise ValueError("No </resources> tag found")
+        line_start = content.rfind('\n', 0, end) + 1
+        if content[line_start:end].strip():
+            insert_lines = '\n' + insert_lines
+            line_start = end
+        content = content[:line_start] + insert_lines + content[line_start:]
+    return content, counts
 
-        # Update Line
-        updated = False
-        for update in update_list:
-            if update in line:
-                new_line = ' <string name="' + update + '">' + update_dict[update] + '</string>\n'
-                print(line.replace(line, new_line),'')
-                # Remove updated list from the list since they are unique
-                update_list.remove(update)
-                updated = True
-                break
 
-        # Just copy the original line
-        if not updated:
-            print(line)
-    text_file.close()
-    print("File Updated.")
+def render_resource(open_tag, tag, item_dict, indent):
+    """
+    Render a resource element.
+    :param open_tag: start of the opening tag, with the name and the other attributes
+    :param tag: string, plurals or string-array
+    :param item_dict: dictionary item:raw value, see get_resource_items
+    :param indent: indentation of the element
+    :return xml:
+    """
+    if tag == 'string':
+        return open_tag + '>' + item_dict[None] + '</string>'
+    item_indent = indent * 2 if indent else DEFAULT_INDENT
+    lines = [open_tag + '>']
+    if tag == 'plurals':
+        for quantity, raw_value in item_dict.items():
+            lines.append(item_indent + '<item quantity="' + quantity + '">' + raw_value + '</item>')
+    else:
+        for index in sorted(item_dict):
+            lines.append(item_indent + '<item>' + item_dict[index] + '</item>')
+    lines.append(indent + '</' + tag + '>')
+    return '\n'.join(lines)
+
+
+def write_file_atomically(file_path, content):
+    """
+    Write the content to a temporary file at the same folder and rename it over the file, so the file is
+    never left half written.
+    :param file_path:
+    :param content:
+    :return:
+    """
+    move(write_temp_file(file_path, content), file_path)
+
+
+def write_temp_file(file_path, content):
+    """
+    Write the content to a temporary file at the same folder of the file, with the same permissions.
+    :param file_path:
+    :param content:
+    :return temp_path:
+    """
+    fd, temp_path = mkstemp(dir=os.path.dirname(os.path.abspath(file_path)), suffix='.tmp')
+    close(fd)
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as temp_file:
+            temp_file.write(content)
+        if os.path.exists(file_path):
+            copymode(file_path, temp_path)
+    except Exception:
+        remove(temp_path)
+        raise
+    return temp_path
+
 
+class FileStage(object):
+    """
+    Set of rewritten files waiting to be applied. Each new file is written to a temporary file next to the
+    original one, and they are only renamed over the originals by commit, once every file is ready, so a
+    failed run doesn't leave the tree half updated.
+    """
 
-def replaceText(node, newText):
-    if node.firstChild.nodeType != node.TEXT_NODE:
-        raise Exception("node does not contain text")
+    def __init__(self):
+        self.files = OrderedDict()
+        self._lock = threading.Lock()
 
-    node.firstChild.replaceWholeText(newText)
+    def add(self, file_path, old_content, new_content):
+        """
+        Stage the new content of a file.
+        :param file_path:
+        :param old_content: current content, for the diff
+        :param new_content:
+        :return:
+        """
+        temp_path = write_temp_file(file_path, new_content)
+        with self._lock:
+            if file_path in self.files:
+                remove(self.files[file_path][0])
+                # The diff is always against the original file
+                old_content = self.files[file_path][1]
+            self.files[file_path] = (temp_path, old_content, new_content)
 
+    def get_content(self, file_path):
+        """
+        :param file_path:
+        :return content: the staged content of the file, None if it is not staged
+        """
+        with self._lock:
+            if file_path in self.files:
+                return self.files[file_path][2]
+        return None
 
-def encode_android_res_lang(language):
+    def diff(self):
+        """
+        Get the unified diff of all the staged files.
+        :return diff:
+        """
+        import difflib
+        lines = []
+        for file_path, (temp_path, old_content, new_content) in sorted(self.files.items()):
+            lines.extend(difflib.unified_diff(old_content.splitlines(True), new_content.splitlines(True),
+                                              'a/' + file_path, 'b/' + file_path))
+        return ''.join(lines)
+
+    def commit(self):
+        """
+        Rename every staged file over its original.
+        :return count: number of files written
+        """
+        for file_path, (temp_path, old_content, new_content) in self.files.items():
+            move(temp_path, file_path)
+        count = len(self.files)
+        self.files.clear()
+        return count
+
+    def discard(self):
+        for temp_path, old_content, new_content in self.files.values():
+            remove(temp_path)
+        self.files.clear()
+
+
+def encode_android_res_lang(qualifiers, supported_languages=None):
     """
     Convert Android resource language identification pattern to Google API Pattern language identification pattern.
 
@@ -188,15 +2606,63 @@ def encode_android_res_lang(language):
     Android Resources
     https://developer.android.com/guide/topics/resources/providing-resources.html
     The android resouce language identification is defined by a two-letter ISO 639-1 language code, optionally followed
-    by a two letter ISO 3166-1-alpha-2 region code (preceded by lowercase "r").
+    by a two letter ISO 3166-1-alpha-2 region code (preceded by lowercase "r"), or by a BCP-47 tag preceded by "b+".
     The codes are not case-sensitive; the r prefix is used to distinguish the region portion. You cannot specify a region alone.
-    :param dir:
-    :return:
+
+    The most specific code known by the API is used, so zh-rTW is translated to zh-TW but pt-rBR to pt.
+    :param qualifiers: qualifiers of the folder name, eg. pt-rBR or b+sr+Latn
+    :param supported_languages: dictionary lowercase code:code of the provider, None to accept any language
+    :return language: None if the folder is not a language or the language is not supported
     """
-    if '-r' in language:
-        language = language.split('-r')
-        return language[0] + "-" + language[1].lower()
-    return language
+    subtags = parse_language_qualifier(qualifiers)
+    if subtags is None:
+        return None
+    language, script, region = subtags
+    candidate_list = []
+    if script:
+        candidate_list.append(language + '-' + script)
+    if region:
+        candidate_list.append(language + '-' + region)
+    candidate_list.append(language)
+    for candidate in candidate_list:
+        code = LANGUAGE_CODES.get(candidate.lower())
+        if supported_languages is None:
+            if code is not None or candidate == language:
+                return code or language
+            continue
+        for code in (code, candidate):
+            if code is not None and code.lower() in supported_languages:
+                return supported_languages[code.lower()]
+    return None
+
+
+def parse_language_qualifier(qualifiers):
+    """
+    Parse the qualifiers of a language folder.
+    :param qualifiers: qualifiers of the folder name, eg. pt-rBR, mcc310-en-rUS or b+sr+Latn
+    :return language, script, region: script and region are None when missing, None if it is not a language
+    """
+    match = LANGUAGE_QUALIFIER_PATTERN.match(qualifiers)
+    if match is None:
+        return None
+    if match.group('tag') is None:
+        language = match.group('language').lower()
+        if language in NON_LANGUAGE_QUALIFIERS:
+            return None
+        region = match.group('region')
+        return language, None, region.upper() if region else None
+    subtag_list = match.group('tag').split('+')
+    language = subtag_list[0].lower()
+    if not 2 <= len(language) <= 3 or not language.isalpha():
+        return None
+    script = None
+    region = None
+    for subtag in subtag_list[1:]:
+        if len(subtag) == 4 and subtag.isalpha():
+            script = subtag.capitalize()
+        elif (len(subtag) == 2 and subtag.isalpha()) or (len(subtag) == 3 and subtag.isdigit()):
+            region = subtag.upper()
+    return language, script, region
 
 
 def main():
@@ -205,36 +2671,251 @@ def main():
     parser.add_argument("-v", "--verbose", action="store_true")
     parser.add_argument("-i", "--ignored_languages_list", type=str,
                         help="String containing the language which files should be ignored on at translation. Comma separated list. eg. ar,pt")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of languages translated at the same time. eg. 8")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Don't use the translation memory, every string is sent to the API")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Translate again the strings found at the translation memory and store the new translations")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Translate only the strings added or modified at the base strings.xml since the last "
+                             "incremental run, and remove the deleted ones")
+    parser.add_argument("--scan", action="store_true",
+                        help="Take the path as a project root and translate every resource folder found under it "
+                             "(each folder with a values/strings.xml) with a single translation plan")
+    parser.add_argument("--report", action="store_true",
+                        help="Don't translate, just report the missing, stale and extra strings of each language and "
+                             "the estimated cost")
+    parser.add_argument("--report-format", choices=['table', 'json'], default='table',
+                        help="Output format of the report")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Don't change any file, just print the diff of the changes")
+    parser.add_argument("--resume", action="store_true",
+                        help="Resume an interrupted run, the translations it already did are taken from its journal")
+    parser.add_argument("--export", type=str,
+                        help="Don't translate, export the strings to be translated of each language to a XLIFF 1.2 "
+                             "(.xlf or .xliff) or CSV file, to be translated out of the API")
+    parser.add_argument("--import", type=str, dest="import_path",
+                        help="Apply the translations of an exported XLIFF or CSV file to the language files")
+    parser.add_argument("--max-chars", type=int, default=0,
+                        help="Maximum number of characters sent to the API, the languages that don't fit are skipped. "
+                             "eg. 500000")
+    parser.add_argument("--priority", type=str,
+                        help="Languages translated first, so they are the ones done when the --max-chars budget runs "
+                             "out. Comma separated list, most important first. eg. es,pt-rBR,de")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running and translate the strings changed at the base strings.xml each time it "
+                             "is saved, until Ctrl+C")
+    parser.add_argument("--watch-interval", type=float, default=WATCH_INTERVAL,
+                        help="Seconds between two checks of the base strings.xml at the watch mode")
+    parser.add_argument("--metrics", type=str,
+                        help="File where the timings and counters of the run are saved as JSON")
+    parser.add_argument("--openmetrics", type=str,
+                        help="File where the timings and counters of the run are saved as OpenMetrics text")
     parser.add_argument("path", type=str, help="The base path")
-    parser.add_argument("string_list", type=str,
+    parser.add_argument("string_list", type=str, nargs='?',
                         help="String of the base string.xml to be translated. Comma separated list eg, app_name,dialog_positive,loading_msg")
     args = parser.parse_args()
+    if not args.string_list and not args.incremental and not args.report and not args.watch and not args.import_path:
+        parser.error("the string_list is required unless --incremental, --report, --watch or --import are used")
 
-    list = args.string_list.split(',')
+    list = args.string_list.split(',') if args.string_list else []
 
     if args.verbose:
         print("Starting translation script")
     # System folders names that follows the pattern values-* and HAVE to be ignored
-    ignored_language_list = ['w820dp', 'v21']
+    ignored_language_list = []
     if args.ignored_languages_list:
         ignored_language_list += args.ignored_languages_list.split(',')
         if args.verbose:
             print("Ignoring Languages: " + args.ignored_languages_list)
 
+    base_path_list = [args.path]
+    if args.scan:
+        base_path_list = find_modules(args.path)
+        if args.verbose:
+            print("Found %d resource folders" % len(base_path_list))
+
+    if args.report:
+        report = build_report(base_path_list, ignored_language_list)
+        cost_per_million_chars = read_settings()['translate'].getfloat('cost_per_million_chars',
+                                                                        COST_PER_MILLION_CHARS)
+        if args.report_format == 'json':
+            report['estimated_cost'] = report['totals']['characters'] * cost_per_million_chars / 1000000.0
+            print(json.dumps(report, indent=2))
+        else:
+            print_report(report, cost_per_million_chars)
+        return
+
+    if args.import_path:
+        # The files are staged and only written when every row is applied
+        stage = FileStage()
+        config = read_settings()
+        # The imported translations are kept at the translation memory, as the ones of the API
+        memory = open_translation_memory(config) if not args.no_cache and not args.dry_run else None
+        try:
+            counts, done_dict = import_bundle(args.import_path, args.verbose, stage, memory,
+                                              get_provider_class(config['translate']).name)
+            print("%d translations imported, %d stale and %d invalid skipped" %
+                  (counts['imported'], counts['stale'], counts['invalid']))
+            if args.dry_run:
+                print(stage.diff(), end='')
+                print("Dry run, %d files would be changed" % len(stage.files))
+            else:
+                print("%d files changed" % stage.commit())
+                # The next incremental run doesn't translate again the imported strings
+                for base_path, base_done_dict in done_dict.items():
+                    update_manifest(base_path, base_done_dict)
+        finally:
+            stage.discard()
+            if memory is not None:
+                memory.close()
+        return
+
+    module_list = []
+    base_dict_list = []
+    base_parse_start = time.perf_counter()
+    for base_path in base_path_list:
+        removed_list = []
+        if args.incremental:
+            if args.verbose:
+                print("Comparing base strings of " + base_path + " with the last run...")
+            base_dict = get_string_dict(base_path)
+            base_dict_list.append((base_path, base_dict))
+            manifest = load_manifest(base_path)
+            if manifest is None:
+                # Without a manifest there is no way to know what changed, so the existing translations are kept
+                # and only the strings missing at the language files are translated
+                print("No manifest at %s yet, only the missing strings are translated" % base_path)
+                string_dict = OrderedDict()
+            else:
+                string_dict, removed_list = diff_manifest(manifest, base_dict)
+            # Strings passed explicitly are translated even if they didn't change
+            string_dict.update(get_string_dict(base_path, list))
+            print("Incremental run of %s: %d strings to translate, %d removed" %
+                  (base_path, len(string_dict), len(removed_list)))
+        else:
+            if args.verbose:
+                print("Getting default values of " + base_path + " for " + ",".join(str(x) for x in list) + "...")
+            # Get the values of the list to be translated
+            string_dict = get_string_dict(base_path, list)
+            if args.verbose:
+                print("Done.")
+        if args.incremental:
+            # The strings missing at a language file are translated too, even if they didn't change
+            module_list.append((base_path, string_dict, removed_list, base_dict))
+        elif string_dict:
+            module_list.append((base_path, string_dict, removed_list, None))
+    metrics.add_time('base_parse', time.perf_counter() - base_parse_start)
+
+    if args.export:
+        source_language = read_settings()['translate'].get('source_language', SOURCE_LANGUAGE)
+        count = export_bundle(args.export, module_list, ignored_language_list, source_language)
+        print("%d strings exported to %s" % (count, args.export))
+        return
+
     if args.verbose:
-        print("Getting default values for " + ",".join(str(x) for x in list) + "...")
-    # Get the values of the list to be translated
-    string_dict = get_string_dict(args.path, list)
-    if args.verbose:
-        print("Done.")
+        print("Loading translation client...")
+    # The same client is reused by every translation request of the run
+    journal = Journal(resume=args.resume)
+    if args.resume:
+        print("Resuming the interrupted run, %d translations at the journal" % len(journal.entries))
+    with metrics.timer('config_load'):
+        client = TranslationClient(use_cache=not args.no_cache, refresh_cache=args.refresh, journal=journal,
+                                   max_chars=args.max_chars,
+                                   priority_list=args.priority.split(',') if args.priority else None)
 
     if args.verbose:
         print("Start Translation Files")
     # Start translating the strings on each file
-    translate_files(args.path, string_dict, ignored_language_list, args.verbose)
+    # The files are staged and only written when every language succeeds
+    stage = FileStage()
+    try:
+        failed_list = []
+        changed_files = 0
+        if args.scan:
+            failed_list = translate_modules(client, module_list, ignored_language_list, args.verbose, args.jobs,
+                                            stage)
+        elif module_list:
+            base_path, string_dict, removed_list, base_dict = module_list[0]
+            failed_list = translate_files(client, base_path, string_dict, ignored_language_list, args.verbose,
+                                          args.jobs, removed_list, base_dict, stage)
+        for language, error in failed_list:
+            print("Failed " + language + ": " + error)
+
+        if args.dry_run:
+            print(stage.diff(), end='')
+            print("Dry run, %d files would be changed" % len(stage.files))
+        elif failed_list:
+            # The translations already done are at the translation memory, so running again is cheap
+            print("No file changed because some languages failed")
+        else:
+            changed_files = stage.commit()
+            print("%d files changed" % changed_files)
+            # The skipped languages still need the changed strings
+            if args.incremental and not client.skipped_list:
+                for base_path, base_dict in base_dict_list:
+                    save_manifest(base_path, base_dict)
+            # Nothing left to resume
+            journal.remove()
+    finally:
+        stage.discard()
+
+    if args.watch:
+        # The journal is only needed to resume a single run
+        journal.close()
+        client.journal = None
+        watch(client, base_path_list, ignored_language_list, args.verbose, args.jobs, args.watch_interval,
+              args.dry_run, args.incremental)
 
     print("------------------------------------------------")
-    print("--- Execution time %s seconds ---" % (time.time() - start_time))
+    print("--- Client setup %s seconds, reused by %d requests (%s seconds saved) ---" %
+          (client.setup_time, client.request_count, client.saved_setup_time()))
+    print("--- %d characters sent to the API, %d saved by duplicated strings ---" %
+          (client.sent_chars, client.saved_chars))
+    print("--- Throttled %s seconds by the rate limit, %d retries waited %s seconds ---" %
+          (client.rate_limiter.throttled_time, client.retry_count, client.retry_time))
+    if args.resume:
+        print("--- %d translations replayed from the journal ---" % journal.hits)
+    if client.max_chars:
+        print("--- %d of the %d characters of the budget planned, %d languages skipped ---" %
+              (client.planned_chars, client.max_chars, len(client.skipped_list)))
+    if client.invalid_count:
+        print("--- %d translations flagged and not written, they changed the placeholders or the markup ---" %
+              client.invalid_count)
+    if client.memory is not None:
+        print("--- Translation memory %d hits, %d misses, %d evicted ---" %
+              (client.memory.hits, client.memory.misses, client.memory.evictions))
+    client.close()
+    total_time = time.time() - start_time
+    print("--- Execution time %s seconds ---" % total_time)
+
+    if args.metrics or args.openmetrics:
+        metrics.add_time('total', total_time)
+        cost_per_million_chars = read_settings()['translate'].getfloat('cost_per_million_chars',
+                                                                        COST_PER_MILLION_CHARS)
+        metrics.set_counters(api_calls=client.request_count,
+                             characters_sent=client.sent_chars,
+                             characters_saved=client.saved_chars,
+                             cache_hits=client.memory.hits if client.memory is not None else 0,
+                             cache_misses=client.memory.misses if client.memory is not None else 0,
+                             journal_hits=journal.hits,
+                             retries=client.retry_count,
+                             invalid_translations=client.invalid_count,
+                             planned_characters=client.planned_chars,
+                             skipped_languages=len(client.skipped_list),
+                             retry_seconds=client.retry_time,
+                             throttled_seconds=client.rate_limiter.throttled_time,
+                             failed_languages=len(failed_list),
+                             files_changed=changed_files,
+                             estimated_cost=client.sent_chars * cost_per_million_chars / 1000000.0)
+        if args.metrics:
+            with open(args.metrics, 'w') as metrics_file:
+                json.dump(metrics.to_dict(), metrics_file, indent=2, sort_keys=True)
+                metrics_file.write('\n')
+        if args.openmetrics:
+            with open(args.openmetrics, 'w') as metrics_file:
+                metrics_file.write(metrics.to_openmetrics())
 
 if __name__ == '__main__':
     main()